@@ -19,9 +19,17 @@ Here are the steps you can take to automate this process:
 from ftplib import FTP, error_perm
 import os
 import shutil
+import json
+import hashlib
+import errno
+import re
 import logging
 import time
-import schedule
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from job_runner import JobRunner
+from instrumentation import JobMetrics, setup_logging
 
 
 # Ftp server's domain name or ip address
@@ -37,92 +45,481 @@ FTP_PASS = os.getenv('PASS')
 LOCAL_DIRECTORY = 'backup_directory'
 # The shared directory for other systems in the internal network
 NETWORK_SHARED_DIRECTORY = "nfs_shared_directory"
+# Number of ftp sessions that download the files in parallel
+FTP_WORKER_COUNT = 4
+# Number of attempts to download one file before giving up on it
+MAX_DOWNLOAD_ATTEMPTS = 3
+# Seconds to wait before the first retry. The waiting time doubles for every following retry
+RETRY_BACKOFF_SECONDS = 2
+# Download only the new or changed files. The manifest keeps the size and modify time of the downloaded files
+INCREMENTAL_SYNC = True
+FTP_MANIFEST_FILE = "ftp_manifest.json"
+# Size of the blocks read from the data connection while downloading
+FTP_BLOCKSIZE = 1024 * 1024
+# Maximum number of downloaded files waiting to be moved to the network shared directory. The downloads pause
+# when the queue is full, so the local directory never holds more than this number of finished files
+MOVE_QUEUE_SIZE = 16
 
 
-def download_files_by_ftp_to_local_directory():
+class IncompleteDownloadError(Exception):
+    """
+    The downloaded file doesn't have the size listed by the ftp server, or the sha256 computed by the server
+    """
+
+
+class DownloadManifest:
+    """
+    Size and modify time of every downloaded file, as listed by the ftp server. Every downloaded file is appended
+    to a journal next to the manifest, and close() merges the journal into the manifest at the end of the run.
+    The manifest file is replaced atomically, so an interrupted run never leaves a broken manifest
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.journal_path = manifest_path + ".journal"
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.entries = json.load(manifest_file)
+        # Replay the files recorded by an interrupted run
+        line = "\n"
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        filename, entry = json.loads(line)
+                    except ValueError:
+                        # The last line is cut if the run was interrupted while writing it
+                        continue
+                    self.entries[filename] = entry
+        self.journal_file = open(self.journal_path, "a")
+        if not line.endswith("\n"):
+            # End the cut line, so it doesn't swallow the next entry
+            self.journal_file.write("\n")
+
+    def is_unchanged(self, filename, metadata):
+        # Without the size and modify time we can't tell if the file has changed
+        if metadata["size"] is None or metadata["modify"] is None:
+            return False
+        entry = self.entries.get(filename, {})
+        return entry.get("size") == metadata["size"] and entry.get("modify") == metadata["modify"]
+
+    def record(self, filename, metadata, sha256):
+        # Appending one line keeps the cost of a file independent of the size of the manifest
+        entry = {**metadata, "sha256": sha256}
+        with self.lock:
+            self.entries[filename] = entry
+            self.journal_file.write(json.dumps([filename, entry]) + "\n")
+            self.journal_file.flush()
+
+    def close(self):
+        # Merge the journal into the manifest at the end of the run
+        with self.lock:
+            # Write to a temporary file and rename it over the manifest
+            temporary_path = self.manifest_path + ".tmp"
+            with open(temporary_path, "w") as manifest_file:
+                json.dump(self.entries, manifest_file)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            os.replace(temporary_path, self.manifest_path)
+            # A crash before the removal only replays entries that are already in the manifest
+            self.journal_file.close()
+            os.remove(self.journal_path)
+
+
+def open_ftp_connection():
     # Connect to FTP server
-    print("Connecting to the ftp server")
-    ftp_connection = FTP(FTP_SERVER)
-    # Login to FTP server
-    print("Logging in to the ftp server")
-    ftp_connection.login(FTP_USER,FTP_PASS)
+    ftp_connection = FTP()
+    ftp_connection.connect(FTP_SERVER, int(PORT))
+    try:
+        # Login to FTP server
+        ftp_connection.login(FTP_USER,FTP_PASS)
+        # Change the FTP working directory 
+        ftp_connection.cwd(FTP_REMOTE_DIRECTORY)
+        # The command that returns the sha256 of a remote file, if the server has one
+        ftp_connection.sha256_command = find_sha256_command(ftp_connection)
+    except Exception:
+        ftp_connection.close()
+        raise
+
+    return ftp_connection
+
+
+def find_sha256_command(ftp_connection):
+    # Return "HASH" or "XSHA256" when the server can compute the sha256 of a file, None otherwise
+    try:
+        features = [line.strip().upper() for line in ftp_connection.sendcmd("FEAT").splitlines()[1:-1]]
+    except error_perm:
+        return None
+    if any(feature.startswith("HASH") and "SHA-256" in feature for feature in features):
+        try:
+            # Select SHA-256, the default algorithm of HASH may be another one
+            ftp_connection.sendcmd("OPTS HASH SHA-256")
+            return "HASH"
+        except error_perm:
+            pass
+    if "XSHA256" in features:
+        return "XSHA256"
+    return None
+
+
+def get_remote_sha256(ftp_connection, filename):
+    # Return the sha256 of the remote file computed by the server, or None if the server can't compute it
+    sha256_command = getattr(ftp_connection, "sha256_command", None)
+    if sha256_command is None:
+        return None
+    try:
+        # The reply is "213 SHA-256 0-<size> <sha256> <filename>" for HASH and "213 <sha256>" for XSHA256
+        reply = ftp_connection.sendcmd(f"{sha256_command} {filename}")
+    except error_perm as e:
+        logger.warning(f"The server can't compute the sha256 of {filename}: {e}")
+        return None
+    for word in reply[4:].split():
+        if re.fullmatch(r"[0-9a-fA-F]{64}", word):
+            return word.lower()
+    return None
+
+
+def read_part_info(part_info_path):
+    # The size and modify time of the remote file a ".part" file was downloaded from. None if unknown
+    try:
+        with open(part_info_path) as part_info_file:
+            return json.load(part_info_file)
+    except (OSError, ValueError):
+        return None
+
+
+def close_ftp_connection(ftp_connection):
+    if ftp_connection is None:
+        return
+    try:
+        ftp_connection.quit()
+    except Exception:
+        # The connection is already broken
+        ftp_connection.close()
+
+
+def list_remote_files_with_metadata(ftp_connection):
+    # Return {filename: {"size": ..., "modify": ...}} for the files in the ftp working directory
+    try:
+        # MLSD lists the names with their facts in one command
+        return {filename: {"size": int(facts["size"]) if "size" in facts else None, "modify": facts.get("modify")}
+                for filename, facts in ftp_connection.mlsd(facts=["type", "size", "modify"])
+                if facts.get("type", "file") == "file"}
+    except error_perm:
+        # The server doesn't support MLSD. Ask for the size and modify time of every file
+        pass
+
+    # SIZE is only reliable in binary mode
+    ftp_connection.voidcmd("TYPE I")
+    remote_files = {}
+    for filename in ftp_connection.nlst():
+        try:
+            size = ftp_connection.size(filename)
+        except error_perm:
+            size = None
+        try:
+            # The reply is "213 YYYYMMDDHHMMSS"
+            modify = ftp_connection.sendcmd("MDTM " + filename)[4:].strip()
+        except error_perm:
+            modify = None
+        remote_files[filename] = {"size": size, "modify": modify}
+
+    return remote_files
+
+
+def download_file(ftp_connection, filename, remote_size=None, remote_modify=None):
+    # Download into a ".part" file and rename it when it is complete. A failed attempt leaves the ".part" file,
+    # so the next attempt resumes where it stopped instead of downloading the whole file again
+    # os.path.join to join the path segments intelligently for different operating system
+    local_path = os.path.join(LOCAL_DIRECTORY, filename)
+    part_path = local_path + ".part"
+    # The listed size and modify time of the remote file are kept next to the ".part" file
+    part_info_path = part_path + ".json"
+    part_info = {"size": remote_size, "modify": remote_modify}
+    # The checksum is computed while the blocks arrive, so the file is not read again to verify it
+    checksum = hashlib.sha256()
+
+    offset = 0
+    if os.path.exists(part_path):
+        # Resume only a part of the same version of the remote file. Without the size and modify time
+        # we can't tell if the remote file has been replaced since the part was downloaded
+        if (remote_size is not None and remote_modify is not None and read_part_info(part_info_path) == part_info
+                and os.path.getsize(part_path) <= remote_size):
+            offset = os.path.getsize(part_path)
+        else:
+            logger.info(f"Discarding the partial download of {filename}: the remote file may have changed")
+    if not offset:
+        with open(part_info_path, "w") as part_info_file:
+            json.dump(part_info, part_info_file)
+    if offset:
+        # Hash the part downloaded by the previous attempt, so the checksum covers the whole file
+        with open(part_path, 'rb') as downloaded_part:
+            for block in iter(lambda: downloaded_part.read(FTP_BLOCKSIZE), b""):
+                checksum.update(block)
+
+    # Open the file in the binary mode because "retrbinary" retrieve the data from ftp server in binary mode.
+    # Append to the previous part when resuming
+    with open(part_path, 'ab' if offset else 'wb') as downloaded_file:
+        def write_block(block):
+            downloaded_file.write(block)
+            checksum.update(block)
+
+        if offset:
+            logger.info(f"Resuming {filename} at byte {offset}")
+        else:
+            logger.info(f"Downloading {filename} to {LOCAL_DIRECTORY}")
+        try:
+            # Retrieve the file from the ftp server, starting at the offset with the REST command
+            ftp_connection.retrbinary("RETR " + filename, write_block, blocksize=FTP_BLOCKSIZE, rest=offset or None)
+        except error_perm as e:
+            if not offset or not str(e).startswith(("500", "502", "504")):
+                raise
+            # The server doesn't support REST. Download the whole file
+            logger.warning(f"Resuming {filename} is not supported by the server: {e}")
+            downloaded_file.seek(0)
+            downloaded_file.truncate()
+            checksum = hashlib.sha256()
+            ftp_connection.retrbinary("RETR " + filename, write_block, blocksize=FTP_BLOCKSIZE)
+        file_size = downloaded_file.tell()
+
+    # Verify the size against the listing before publishing the file
+    if remote_size is not None and file_size != remote_size:
+        if file_size > remote_size:
+            # The part doesn't belong to the listed file. Don't resume from it
+            os.remove(part_path)
+        raise IncompleteDownloadError(f"{filename} has {file_size} bytes instead of {remote_size}")
+    # Verify the content when the server can compute the sha256 of the file
+    remote_sha256 = get_remote_sha256(ftp_connection, filename)
+    if remote_sha256 is not None and remote_sha256 != checksum.hexdigest():
+        # Don't resume from a corrupt part
+        os.remove(part_path)
+        raise IncompleteDownloadError(f"{filename} has sha256 {checksum.hexdigest()} instead of {remote_sha256}")
+    os.replace(part_path, local_path)
+    os.remove(part_info_path)
+
+    return file_size, checksum.hexdigest()
+
+
+def download_files_worker(file_queue, manifest, move_queue, summary, summary_lock, metrics):
+    # Each worker downloads files from the queue over its own ftp session until the queue is empty
+    ftp_connection = None
+    try:
+        while True:
+            try:
+                filename, metadata = file_queue.get_nowait()
+            except queue.Empty:
+                break
+            # The latency of a file includes its retries
+            file_start_time = time.monotonic()
+
+            for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+                try:
+                    if ftp_connection is None:
+                        ftp_connection = open_ftp_connection()
+                    file_size, sha256 = download_file(ftp_connection, filename, metadata["size"], metadata["modify"])
+                    logger.info(f"Downloaded {filename} ({file_size} bytes, sha256 {sha256})")
+                    # Remember the downloaded version, so the next run skips it while it is unchanged
+                    if manifest is not None:
+                        manifest.record(filename, metadata, sha256)
+                    with summary_lock:
+                        summary["downloaded"] += 1
+                        summary["bytes"] += file_size
+                    metrics.record_item(time.monotonic() - file_start_time, file_size)
+                    # Hand the file to the mover while this worker downloads the next one
+                    if move_queue is not None:
+                        move_queue.put(os.path.join(LOCAL_DIRECTORY, filename))
+                    break
+                except error_perm as e:
+                    # Permanent error (e.g. no such file or permission denied). Retrying doesn't help
+                    logger.error(f"Downloading {filename} failed: {e}")
+                    error = None
+                except Exception as e:
+                    # The session may be broken. Reconnect for the next attempt
+                    close_ftp_connection(ftp_connection)
+                    ftp_connection = None
+                    error = e
+
+                if error is not None and attempt < MAX_DOWNLOAD_ATTEMPTS:
+                    logger.warning(f"Downloading {filename} failed: {error}. Retrying")
+                    metrics.record_retry()
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                else:
+                    if error is not None:
+                        logger.error(f"Downloading {filename} failed after {MAX_DOWNLOAD_ATTEMPTS} attempts: {error}")
+                    with summary_lock:
+                        summary["failed"].append(filename)
+                    metrics.record_failure()
+                    break
+    finally:
+        close_ftp_connection(ftp_connection)
+
+
+def download_files_by_ftp_to_local_directory(worker_count=FTP_WORKER_COUNT, incremental=INCREMENTAL_SYNC, move_queue=None, metrics=None):
+    start_time = time.monotonic()
+    # Without the metrics of a task, the download logs its own metrics
+    own_metrics = metrics is None
+    if own_metrics:
+        metrics = JobMetrics("download_files_by_ftp_to_local_directory")
+    # Connect and login to the ftp server, then change the working directory
+    logger.info("Connecting to the ftp server")
+    ftp_connection = open_ftp_connection()
     # Get the welcome message from the server
-    print("Welcome message: " + ftp_connection.getwelcome())
-    # Change the FTP working directory 
-    print(f"Changing the ftp working directory to {FTP_REMOTE_DIRECTORY}")
-    ftp_connection.cwd(FTP_REMOTE_DIRECTORY)
-    # Get the list of files
-    filelist = ftp_connection.nlst()
+    logger.info("Welcome message: " + ftp_connection.getwelcome())
+    # Get the list of files with their size and modify time
+    remote_files = list_remote_files_with_metadata(ftp_connection)
+    # Close the ftp connection. The workers open their own sessions
+    close_ftp_connection(ftp_connection)
 
+    # Compare the listing with the manifest of the previous runs
+    manifest = DownloadManifest(FTP_MANIFEST_FILE) if incremental else None
+    filelist = [filename for filename, metadata in remote_files.items()
+                if manifest is None or not manifest.is_unchanged(filename, metadata)]
+
+    # Queue of the files to download, shared by the workers
+    file_queue = queue.Queue()
     for filename in filelist:
-        # Open the file for writing in the binary mode because "retrbinary" retrieve the data from ftp server in binary mode
-        # os.path.join to join the path segments intelligently for different operating system
-        with open(os.path.join(LOCAL_DIRECTORY,filename), 'wb') as downloaded_file:
-            # Retrieve the file from the ftp server
-            print(f"Downloading {filename} to {LOCAL_DIRECTORY}")
-            logger.info(f"Downloading {filename} to {LOCAL_DIRECTORY}")
-            ftp_connection.retrbinary("RETR " + filename ,downloaded_file.write)
+        file_queue.put((filename, remote_files[filename]))
+
+    summary = {"downloaded": 0, "bytes": 0, "failed": [], "skipped": len(remote_files) - len(filelist)}
+    summary_lock = threading.Lock()
+    metrics.increment("skipped_unchanged", summary["skipped"])
+    logger.info(f"Downloading {len(filelist)} files to {LOCAL_DIRECTORY} with {worker_count} ftp sessions")
+    try:
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            workers = [executor.submit(download_files_worker, file_queue, manifest, move_queue, summary, summary_lock, metrics)
+                       for _ in range(min(worker_count, len(filelist)))]
+            for worker in workers:
+                worker.result()
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    summary["seconds"] = time.monotonic() - start_time
+    logger.info(f"Downloaded {summary['downloaded']} files ({summary['bytes']} bytes) in {summary['seconds']:.1f} seconds. "
+                f"Skipped unchanged: {summary['skipped']}. Failed: {len(summary['failed'])}", extra={"summary": summary})
+    if own_metrics:
+        metrics.log_summary(logger)
+
+    return summary
+
 
-    # Close the ftp connection
-    print("Closing the ftp connection")
-    ftp_connection.close()
+def publish_file_to_network_shared_directory(local_path):
+    destination_path = os.path.join(NETWORK_SHARED_DIRECTORY, os.path.basename(local_path))
+    logger.info(f"Moving {os.path.basename(local_path)} to {NETWORK_SHARED_DIRECTORY}")
+    try:
+        # On the same file system the move is a rename. No data is copied
+        os.replace(local_path, destination_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The share is on another device. Copy to a temporary name first, so other systems never see a half copied file
+        temporary_path = destination_path + ".part"
+        shutil.copy2(local_path, temporary_path)
+        os.replace(temporary_path, destination_path)
+        os.remove(local_path)
+
+    return destination_path
 
 
-def move_file_by_shutil_to_network_shared_directory():
+def notify_published(on_published, published_path):
+    # Call on_published with the path of a published file. The file is already published, so an error of the
+    # callback (e.g. the pipeline has stopped) is only logged and is not a failed move
+    if on_published is None:
+        return
+    try:
+        on_published(published_path)
+    except Exception as e:
+        logger.error(f"Reporting the published file {published_path} failed: {e}")
 
-    # Walk through all file in local directory
-    for _, _, filenames in os.walk(LOCAL_DIRECTORY):
-        # Move all files in the filenames to network shared directory
-        for filename in filenames:
-            print(f"Moving {filename} to {NETWORK_SHARED_DIRECTORY}") 
-            logger.info(f"Moving {filename} to {NETWORK_SHARED_DIRECTORY}") 
-            shutil.move(os.path.join(LOCAL_DIRECTORY, filename), os.path.join(LOCAL_DIRECTORY, NETWORK_SHARED_DIRECTORY))
 
-def transfer_daily_files_from_ftp_to_local_network():
-    print("Task has Started")
+def move_files_worker(move_queue, summary, metrics, on_published=None):
+    # Move the downloaded files to the network shared directory as soon as they arrive, until getting None.
+    # on_published is called with the path of every published file
+    while True:
+        local_path = move_queue.get()
+        if local_path is None:
+            break
+        try:
+            published_path = publish_file_to_network_shared_directory(local_path)
+        except Exception as e:
+            # The file stays in the local directory and is moved by the next run
+            logger.error(f"Moving {local_path} failed: {e}")
+            summary["failed"].append(local_path)
+            metrics.increment("move_failures")
+            continue
+        summary["moved"] += 1
+        metrics.increment("moved")
+        notify_published(on_published, published_path)
+
+
+def move_file_by_shutil_to_network_shared_directory(on_published=None):
+
+    # Move the files left in the local directory by an interrupted run. Skip the unfinished downloads
+    for filename in os.listdir(LOCAL_DIRECTORY):
+        local_path = os.path.join(LOCAL_DIRECTORY, filename)
+        if os.path.isfile(local_path) and not filename.endswith((".part", ".part.json")):
+            published_path = publish_file_to_network_shared_directory(local_path)
+            notify_published(on_published, published_path)
+
+def transfer_daily_files_from_ftp_to_local_network(on_published=None):
+    # on_published is called with the path of every file published to the network shared directory
     logger.info("Task has Started")
+    # Files per second, bytes transferred, latencies and retries of this run
+    metrics = JobMetrics("transfer_daily_files_from_ftp_to_local_network")
     try:
         # check if the local directory exists. Create it if doesn't exist
         if not os.path.exists(LOCAL_DIRECTORY):
             os.mkdir(LOCAL_DIRECTORY)
-        # Start downloading file from ftp server
-        download_files_by_ftp_to_local_directory()
         # Check if the network shared folder exist
         if not os.path.exists(NETWORK_SHARED_DIRECTORY):
             # Create the directory if it doesn't exist
             os.mkdir(NETWORK_SHARED_DIRECTORY)
-        # Start moving files
-        move_file_by_shutil_to_network_shared_directory()
+        # Move the files left by a previous run
+        move_file_by_shutil_to_network_shared_directory(on_published)
+
+        # The mover publishes every file as soon as its download finishes, while the other downloads continue
+        move_queue = queue.Queue(maxsize=MOVE_QUEUE_SIZE)
+        move_summary = {"moved": 0, "failed": []}
+        mover = threading.Thread(target=move_files_worker, args=(move_queue, move_summary, metrics, on_published))
+        mover.start()
+        try:
+            # Start downloading file from ftp server
+            download_files_by_ftp_to_local_directory(move_queue=move_queue, metrics=metrics)
+        finally:
+            # Let the mover finish the queued files
+            move_queue.put(None)
+            mover.join()
+        logger.info(f"Moved {move_summary['moved']} files to {NETWORK_SHARED_DIRECTORY}. Failed: {len(move_summary['failed'])}")
 
     except error_perm as e:
         # Ftp user cannot log in error
-        print(e)
-        logging.error(e)    
+        logger.error(e)
     except Exception as e:
-        print(e)
-        logging.error(e)
+        logger.error(e)
     else:
-        print("Task finished successfully")
         # If there is no exception, write to log file with INFO log level
         logger.info("Task finished successfully")
+    finally:
+        # Dump the metrics of the run to the log
+        metrics.log_summary(logger)
 
 
-# Schedule the task to be run every day at 7:46 PM
-schedule.every().day.at("19:46").do(transfer_daily_files_from_ftp_to_local_network)
-
-# Configure logging to log events to events.log file with the specified format.
-logging.basicConfig(filename='events.log', level=logging.INFO,
-                    format='%(asctime)s %(levelname)s %(name)s %(message)s')
-
 # Loggers should NEVER be instantiated directly, but always through the module-level function logging.getLogger. A good convention to use when naming loggers is to use a module-level logger
 logger=logging.getLogger(__name__)
 
-# Keep the script running 
-while True:
-    # Run all jobs that are scheduled to run
-    schedule.run_pending()
-    time.sleep(1)
 
+def register_jobs(runner):
+    # Schedule the task to be run every day at 7:46 PM. A run of today missed by less than the runner's misfire grace (an hour) is caught up, the task skips the work already done
+    runner.every_day_at("19:46", transfer_daily_files_from_ftp_to_local_network, catch_up=True)
 
 
+if __name__ == "__main__":
+    # Log events to events.log file as json lines and to the console, from a background thread
+    setup_logging('events.log')
 
+    # Keep the script running. The runner sleeps until the task is due
+    runner = JobRunner()
+    register_jobs(runner)
+    exit(runner.run_forever())
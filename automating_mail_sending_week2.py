@@ -20,16 +20,65 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
+from email.policy import SMTP as SMTP_POLICY
 import csv
-import schedule
+import itertools
+import re
+import uuid
 import time
 import logging
 import os
+import queue
+import threading
+import sqlite3
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from job_runner import JobRunner
+from rate_limiter import RateLimiter
+from instrumentation import JobMetrics, setup_logging
 
 
-def create_message(sender_email, receiver_name, receiver_email):
-    # Create MIME Multipart email. Allowing for attachments to be included in the email
-    message = MIMEMultipart()
+# Mail server's domain name or IP address
+SMTP_SERVER = ""
+# Default mail submission port
+SMTP_PORT = 587
+SENDER_EMAIL = ""
+# Start TLS and log in before sending. Disable it to send to a local stand-in SMTP server (e.g. aiosmtpd) while testing
+SMTP_USE_TLS = True
+# Number of SMTP connections that send the emails in parallel
+SMTP_CONNECTIONS = 4
+# Reconnect after sending this number of messages on one connection. Providers limit the messages per session
+MESSAGES_PER_CONNECTION = 100
+# Global limit of sent messages per second for all connections together. 0 to disable the limit
+MAX_MESSAGES_PER_SECOND = 10
+# Maximum number of recipients waiting in the work queue. Reading the csv file pauses when the queue is full
+WORK_QUEUE_SIZE = 1000
+# SQLite journal of the delivered emails. A restarted run skips the recipients that already got the day's report
+DELIVERY_JOURNAL_FILE = "delivery_journal.db"
+# Number of deliveries written to the journal in one transaction
+JOURNAL_BATCH_SIZE = 100
+# Number of attempts to send one email before giving up on the recipient
+MAX_SEND_ATTEMPTS = 3
+# Seconds to wait before the first retry. The waiting time doubles for every following retry
+RETRY_BACKOFF_SECONDS = 2
+# The folder containing the generated reports that are attached to every email
+REPORTS_FOLDER = "generated_reports_folder"
+# Upper bound (in bytes of encoded attachments) for the rendered attachments kept for the run.
+# Larger report sets are encoded again for every message while it is sent
+MAX_ATTACHMENT_CACHE_BYTES = 256 * 1024 * 1024
+# Size of the pieces written to the socket while streaming the message DATA
+DATA_CHUNK_SIZE = 64 * 1024
+
+# The attachments rendered once as the bytes of the message's tail, shared by reference between all messages
+attachments_fragment_cache = {}
+# The cache is shared by the sending threads
+attachment_cache_lock = threading.Lock()
+
+
+def create_message_chunks(sender_email, receiver_name, receiver_email, attachments_chunks, boundary):
+    # Build the message as an iterator of bytes chunks ready to be streamed as SMTP DATA. Only the headers and the
+    # greeting are built for every recipient. The attachments chunks come from get_report_attachments_chunks()
+    message = MIMEMultipart(boundary=boundary)
     message["Subject"] = "Daily Report"
     message["From"] = sender_email
     message["To"] = receiver_email
@@ -37,15 +86,64 @@ def create_message(sender_email, receiver_name, receiver_email):
     body = f"""Hi {receiver_name},\n\nHere is the daily report. \n\nBest Regards """
     message.attach(MIMEText(body,'plain'))
 
-    # Attach all reports in specific folder
-    # Get all filenames
-    file_list = os.listdir("generated_reports_folder")
-    for report_file_name in file_list:
-        # Add each file in the folder to the message
-        part = add_attachment(os.path.join("generated_reports_folder", report_file_name))
-        message.attach(part)
+    # Render with CRLF line endings and drop the closing boundary. The attachments fragment continues the multipart
+    head = message.as_bytes(policy=SMTP_POLICY)
+    closing_boundary = b"--" + boundary.encode() + b"--\r\n"
+    head = head[:-len(closing_boundary)]
+
+    return itertools.chain([quote_periods(head)], attachments_chunks)
+
+def stream_attachments_fragment(report_paths, boundary):
+    # Read, encode and render the reports one by one, then the closing boundary of the multipart message.
+    # Only one encoded report is in memory at a time
+    delimiter = b"--" + boundary.encode() + b"\r\n"
+    for report_file_path in report_paths:
+        part = add_attachment(report_file_path)
+        # Every chunk starts at the beginning of a line, so the periods can be quoted chunk by chunk
+        yield quote_periods(delimiter + part.as_bytes(policy=SMTP_POLICY) + b"\r\n")
+    yield b"--" + boundary.encode() + b"--\r\n"
+
+def quote_periods(data):
+    # SMTP transparency. A line starting with a period gets an extra period, so it is not read as the end of DATA
+    return re.sub(rb"(?m)^\.", b"..", data)
 
-    return message.as_string()
+def get_report_paths(report_paths=None):
+    # Without report_paths, all the reports in the reports folder are attached
+    if report_paths is None:
+        # Get all filenames
+        report_paths = [os.path.join(REPORTS_FOLDER, report_file_name) for report_file_name in sorted(os.listdir(REPORTS_FOLDER))]
+    return report_paths
+
+def encoded_size(file_size):
+    # Size of a file after base64 encoding in lines of 76 characters with CRLF line endings
+    base64_size = (file_size + 2) // 3 * 4
+    return base64_size + (base64_size + 75) // 76 * 2
+
+def get_report_attachments_chunks(boundary, report_paths=None):
+    # Return the attachments as a list of bytes chunks. Within the memory bound they are rendered once into one
+    # fragment shared by all the messages, and rendered again only when a report has changed. A bigger report set
+    # is returned as a generator that encodes the reports while the message is sent
+    report_paths = get_report_paths(report_paths)
+    # The modification time and size tell us if a report has changed, without reading it
+    signature = []
+    for report_file_path in report_paths:
+        report_stat = os.stat(report_file_path)
+        signature.append((report_file_path, report_stat.st_mtime_ns, report_stat.st_size))
+    signature = (boundary, tuple(signature))
+
+    with attachment_cache_lock:
+        if attachments_fragment_cache.get("signature") == signature:
+            return [attachments_fragment_cache["fragment"]]
+        if attachments_fragment_cache.get("signature", (None,))[0] == boundary:
+            logger.info("The reports have changed during the run. Encoding them again")
+        attachments_fragment_cache.clear()
+
+        if sum(encoded_size(file_size) for _, _, file_size in signature[1]) > MAX_ATTACHMENT_CACHE_BYTES:
+            return stream_attachments_fragment(report_paths, boundary)
+        fragment = b"".join(stream_attachments_fragment(report_paths, boundary))
+        attachments_fragment_cache["fragment"] = fragment
+        attachments_fragment_cache["signature"] = signature
+        return [fragment]
 
 def add_attachment(report_file_path):
 
@@ -68,74 +166,298 @@ def add_attachment(report_file_path):
 
 
 
-def send_daily_report_by_email():
-    print("Task has Started")
-    logger.info("Task has Started")
-    try: # To catch errors and handle them by writing to a log file
-        port = 587 # Default mail submission port
-        smtp_server = "" # mail server's domain name or IP address
-        sender_email = ""   
-        receiver_email = ""
-        # Get the password from the environment variable PASS. Protecting the password from being stored in the script
-        password = os.getenv('PASS')
+class DeliveryJournal:
+    """
+    Durable record of the recipients that got the report of a run date. The deliveries are written in batches,
+    so after a crash at most JOURNAL_BATCH_SIZE recipients get the report again
+    """
+
+    def __init__(self, journal_path, run_date, batch_size=JOURNAL_BATCH_SIZE):
+        self.run_date = run_date
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        # The sending threads share the connection. The lock serializes the access
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS delivered ("
+                                "run_date TEXT NOT NULL, receiver_email TEXT NOT NULL, "
+                                "PRIMARY KEY (run_date, receiver_email))")
+        self.connection.commit()
+        # Load the recipients that were already delivered by an interrupted run of the same date
+        cursor = self.connection.execute("SELECT receiver_email FROM delivered WHERE run_date = ?", (run_date,))
+        self.delivered = {row[0] for row in cursor}
+
+    def is_delivered(self, receiver_email):
+        with self.lock:
+            return receiver_email in self.delivered
+
+    def mark_delivered(self, receiver_email):
+        with self.lock:
+            self.delivered.add(receiver_email)
+            self.pending.append((self.run_date, receiver_email))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
 
-        # Warning. This is only for test. Creating unverified context to bypass 'ssl.SSLCertVerificationError'
-        context = ssl._create_unverified_context()
-        # Create SMTP object and passing the server's domain name or IP address, plus the port number
-        with smtplib.SMTP(smtp_server, port) as server:
-            # Establish a connection to the server
-            server.ehlo()
+    def _flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO delivered VALUES (?, ?)", self.pending)
+            self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def open_smtp_connection(password):
+    # Create SMTP object and passing the server's domain name or IP address, plus the port number
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        # Establish a connection to the server
+        server.ehlo()
+        if SMTP_USE_TLS:
+            # Warning. This is only for test. Creating unverified context to bypass 'ssl.SSLCertVerificationError'
+            context = ssl._create_unverified_context()
             # Start TLS Encryption. Put the SMTP connection in TLS mode
             server.starttls(context=context)
-        
             # Logging In to the server
-            server.login(sender_email, password)
-             # Read csv file containing names with emails
-            with open('email_list.csv','r') as email_list_csv:
-                email_list = csv.reader(email_list_csv)
-
-                for receiver_name, receiver_email in email_list:
-                    # Create email message with attachments
-                    message = create_message(sender_email, receiver_name, receiver_email)
-                    
+            server.login(SENDER_EMAIL, password)
+    except Exception:
+        server.close()
+        raise
+
+    return server
+
+def close_smtp_connection(server):
+    if server is None:
+        return
+    try:
+        server.quit()
+    except smtplib.SMTPException:
+        # The connection is already broken
+        server.close()
+
+def send_message_chunks(server, sender_email, receiver_email, chunks):
+    # Same as server.sendmail() for one recipient, but the DATA is written to the socket chunk by chunk
+    # instead of being joined into one big string first
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(sender_email)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender_email)
+    code, response = server.rcpt(receiver_email)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({receiver_email: (code, response)})
+    server.putcmd("data")
+    code, response = server.getreply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    message_size = 0
+    for chunk in chunks:
+        # Slicing a memoryview doesn't copy the shared attachment bytes
+        chunk_view = memoryview(chunk)
+        for start in range(0, len(chunk_view), DATA_CHUNK_SIZE):
+            server.send(chunk_view[start:start + DATA_CHUNK_SIZE])
+        message_size += len(chunk_view)
+    # The chunks end with CRLF. A single period line ends the DATA
+    server.send(b".\r\n")
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+    return message_size
+
+def deliver_messages(work_queue, password, rate_limiter, journal, boundary, metrics, stop_event, fatal_errors, report_paths=None):
+    # Each worker sends the messages from the work queue over its own SMTP connection until it gets None
+    server = None
+    sent_on_connection = 0
+    try:
+        while True:
+            recipient = work_queue.get()
+            if recipient is None:
+                break
+            # Drain the queue without sending after a fatal error
+            if stop_event.is_set():
+                continue
+            receiver_name, receiver_email = recipient
+            # The latency of a message includes its retries
+            message_start_time = time.monotonic()
+
+            for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+                try:
+                    # Open a new connection after the connection's message limit
+                    if server is None or sent_on_connection >= MESSAGES_PER_CONNECTION:
+                        close_smtp_connection(server)
+                        server = None
+                        try:
+                            server = open_smtp_connection(password)
+                        except (ConnectionRefusedError, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected) as e:
+                            # The server is down or refuses the connection. Every recipient would fail the same way,
+                            # so stop all the workers. The journal lets the next run continue with the remaining recipients
+                            logger.error(f"Cannot connect to the SMTP server: {e}. Stopping the run")
+                            fatal_errors.append(e)
+                            stop_event.set()
+                            break
+                        sent_on_connection = 0
+
+                    # Create email message with attachments. The reports are read and encoded once and reused for every recipient
+                    attachments_chunks = get_report_attachments_chunks(boundary, report_paths)
+                    message_chunks = create_message_chunks(SENDER_EMAIL, receiver_name, receiver_email, attachments_chunks, boundary)
+
+                    # Stay under the provider's sending rate
+                    rate_limiter.wait()
                     # Send the email
-                    send_result = server.sendmail(sender_email, receiver_email, message) 
-                    # If the server responded with reception doesn't exist 
-                    if len(send_result):
-                        logger.error("{receiver_email} does not exist")
+                    message_size = send_message_chunks(server, SENDER_EMAIL, receiver_email, message_chunks)
+                    sent_on_connection += 1
+                    journal.mark_delivered(receiver_email)
+                    metrics.record_item(time.monotonic() - message_start_time, message_size)
+                    break
+
+                except smtplib.SMTPAuthenticationError as e:
+                    # Wrong credentials stop all the workers
+                    fatal_errors.append(e)
+                    stop_event.set()
+                    break
+                except smtplib.SMTPRecipientsRefused as e:
+                    # A 4xx reply (greylisting, mailbox busy, too many recipients) is temporary and is retried.
+                    # Retrying doesn't help for a refused address
+                    code = e.recipients[receiver_email][0]
+                    if code >= 500:
+                        logger.error(f"{receiver_email} was refused: {e}")
+                        metrics.record_failure()
+                        break
+                    error = e
+                except smtplib.SMTPResponseException as e:
+                    # The server refused this message but the connection is still usable. Only 4xx replies are temporary
+                    if e.smtp_code >= 500:
+                        logger.error(f"Sending to {receiver_email} failed: {e}")
+                        metrics.record_failure()
+                        break
+                    error = e
+                except Exception as e:
+                    # The connection may be broken. Reconnect for the next attempt
+                    close_smtp_connection(server)
+                    server = None
+                    error = e
 
+                if attempt < MAX_SEND_ATTEMPTS:
+                    logger.warning(f"Sending to {receiver_email} failed: {error}. Retrying")
+                    metrics.record_retry()
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                else:
+                    logger.error(f"Sending to {receiver_email} failed after {MAX_SEND_ATTEMPTS} attempts: {error}")
+                    metrics.record_failure()
+    finally:
+        close_smtp_connection(server)
 
 
+def send_daily_report_by_email(report_paths=None, run_id=None):
+    # Send the reports (all the reports in the reports folder by default) to every recipient of email_list.csv.
+    # The run_id keys the delivery journal. By default it is today's date, so the daily report is sent once a day.
+    # Return the number of recipients that didn't get the reports, or 1 if the run failed before sending
+    logger.info("Task has Started")
+    # Messages per second, bytes sent, latencies and retries of this run
+    metrics = JobMetrics("send_daily_report_by_email")
+    try: # To catch errors and handle them by writing to a log file
+        # Get the password from the environment variable PASS. Protecting the password from being stored in the script
+        password = os.getenv('PASS')
+        # Start every run with an empty attachment cache so yesterday's reports are not kept in memory
+        attachments_fragment_cache.clear()
+        # One MIME boundary for all the messages of the run, so the rendered attachments can be shared
+        boundary = "=_daily_report_" + uuid.uuid4().hex
+
+        # Bounded queue between the csv reader and the sending workers
+        work_queue = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+        rate_limiter = RateLimiter(MAX_MESSAGES_PER_SECOND)
+        stop_event = threading.Event()
+        fatal_errors = []
+        # Checkpoint of today's deliveries. Rerunning the task only sends to the remaining recipients
+        journal = DeliveryJournal(DELIVERY_JOURNAL_FILE, run_id or datetime.date.today().isoformat())
+
+        try:
+            with ThreadPoolExecutor(max_workers=SMTP_CONNECTIONS) as executor:
+                workers = [executor.submit(deliver_messages, work_queue, password, rate_limiter, journal, boundary, metrics, stop_event, fatal_errors, report_paths)
+                           for _ in range(SMTP_CONNECTIONS)]
+                try:
+                    # Read csv file containing names with emails. The rows are streamed to the workers one by one
+                    with open('email_list.csv','r', newline='') as email_list_csv:
+                        email_list = csv.reader(email_list_csv)
+
+                        for row in email_list:
+                            if stop_event.is_set():
+                                break
+                            # Skip a broken row instead of abandoning the whole run
+                            if len(row) != 2:
+                                logger.error(f"Skipping invalid row {email_list.line_num} of email_list.csv: {row}")
+                                metrics.increment("invalid_rows")
+                                continue
+                            receiver_name, receiver_email = row
+                            # Skip the recipients that were delivered before a restart
+                            if journal.is_delivered(receiver_email):
+                                metrics.increment("already_delivered")
+                                continue
+                            # Wait here while the queue is full
+                            work_queue.put((receiver_name, receiver_email))
+                finally:
+                    # Tell every worker to stop after the queued messages
+                    for _ in workers:
+                        work_queue.put(None)
+
+                for worker in workers:
+                    worker.result()
+        finally:
+            # Write the last batch of deliveries to the journal
+            journal.close()
+
+        if fatal_errors:
+            raise fatal_errors[0]
+
     except smtplib.SMTPAuthenticationError as e:
     # Handling incorrect password exception
-        print(f'Wrong Credentials.\n{e.smtp_error}')
-        logger.error(e)
+        logger.error(f'Wrong Credentials.\n{e.smtp_error}')
         # Stop the script completely because of the authentication problem
         exit(1)
 
     except Exception as e:
-        print(e)
         # Write to log file with ERROR log level
         logger.error(e)
+        metrics.record_failure()
 
     else:
-        print("Task finished successfully")
-        # If there is no exception, write to log file with INFO log level
-        logger.info("Task finished successfully")
+        if metrics.failures:
+            logger.error(f"Task finished. {metrics.failures} recipients did not get the report")
+        else:
+            # If there is no exception, write to log file with INFO log level
+            logger.info("Task finished successfully")
 
+    finally:
+        # Dump the metrics of the run to the log
+        metrics.log_summary(logger)
 
-# Schedule the task to be run every day at 8:25 PM
-schedule.every().day.at("20:25").do(send_daily_report_by_email)
+    return metrics.failures
 
-# Configure logging to log events to messages.log file with the specified format.
-logging.basicConfig(filename='messages.log', level=logging.INFO, 
-                    format='%(asctime)s %(levelname)s %(name)s %(message)s')
 
 # Loggers should NEVER be instantiated directly, but always through the module-level function logging.getLogger. A good convention to use when naming loggers is to use a module-level logger
 logger=logging.getLogger(__name__)
-# Keep the script running 
-while True:
-    # Run all jobs that are scheduled to run
-    schedule.run_pending()
-    time.sleep(1)
 
+
+def register_jobs(runner):
+    # Schedule the task to be run every day at 8:25 PM. A run of today missed by less than the runner's misfire grace (an hour) is caught up, the task skips the work already done
+    runner.every_day_at("20:25", send_daily_report_by_email, catch_up=True)
+
+
+if __name__ == "__main__":
+    # Log events to messages.log file as json lines and to the console, from a background thread
+    setup_logging('messages.log')
+
+    # Keep the script running. The runner sleeps until the task is due
+    runner = JobRunner()
+    register_jobs(runner)
+    exit(runner.run_forever())
@@ -0,0 +1,516 @@
+''' Benchmarks for the homework tools. Run a benchmark by its name, for example:
+
+    python benchmarks.py mail_message --attachment-mb 1 5 20
+    python benchmarks.py caesar --sizes-kb 1 1024 1048576
+    python benchmarks.py weather_records --records 100000
+
+The load tests run a whole job against a local stand-in server instead of the real one: an aiosmtpd SMTP sink,
+a pyftpdlib FTP server and an http.server that answers like openweathermap. They report the throughput,
+the latency percentiles and the peak RSS of the process:
+
+    python benchmarks.py mail_delivery --recipients 1000 --attachments 3 --attachment-kb 512
+    python benchmarks.py ftp_download --files 5000 --file-kb 64
+    python benchmarks.py weather_fetch --requests 2000 --cities 500
+    python benchmarks.py all
+
+aiosmtpd and pyftpdlib are only needed by their load tests (pip install aiosmtpd pyftpdlib).
+Every benchmark prints one line per measurement so the results of two versions can be compared. '''
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import smtplib
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+from instrumentation import percentiles
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. The peak RSS is not reported there
+    resource = None
+
+
+def measure(function, repeat):
+    # Return the average seconds per call and the peak memory (in bytes) allocated by one call
+    function()  # Warm up the caches
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    seconds_per_call = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds_per_call, peak_memory
+
+
+def peak_rss_mb():
+    # Peak resident memory of the whole process so far. ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return float("nan")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def free_port():
+    # A free local port for a stand-in server
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class MetricsCapture(logging.Handler):
+    """
+    Keep the metrics summaries logged by a job and print its warnings and errors
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.summaries = []
+
+    def emit(self, record):
+        if hasattr(record, "metrics"):
+            self.summaries.append(record.metrics)
+        elif record.levelno >= logging.WARNING:
+            print(f"  {record.levelname}: {record.getMessage()}", file=sys.stderr)
+
+
+@contextmanager
+def capture_metrics(logger):
+    # Collect the JobMetrics summaries of the logger instead of writing the job's log
+    handler = MetricsCapture()
+    previous_level, previous_propagate = logger.level, logger.propagate
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        yield handler.summaries
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(previous_level)
+        logger.propagate = previous_propagate
+
+
+def print_load_result(benchmark, parameters, summary):
+    # One line with the throughput, the latency percentiles and the peak RSS of a load test
+    latencies = " ".join(f"p{percent}={summary.get(f'latency_p{percent}', 0) * 1000:.1f}ms" for percent in (50, 95, 99))
+    print(f"{benchmark} {parameters} items={summary['items']} failures={summary['failures']} retries={summary['retries']} "
+          f"time={summary['seconds']:.2f}s throughput={summary['items_per_second']:.1f}/s "
+          f"bytes={summary['bytes_per_second'] / 1024 / 1024:.1f}MB/s {latencies} peak_rss={peak_rss_mb():.1f}MB")
+
+
+@contextmanager
+def working_directory(path):
+    previous_directory = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_directory)
+
+
+def create_message_as_string(mail, sender_email, receiver_name, receiver_email):
+    # The original message builder of the mail script, kept as the baseline. Every report is read and encoded
+    # again for every message and the whole message is joined into one string
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    message = MIMEMultipart()
+    message["Subject"] = "Daily Report"
+    message["From"] = sender_email
+    message["To"] = receiver_email
+    body = f"""Hi {receiver_name},\n\nHere is the daily report. \n\nBest Regards """
+    message.attach(MIMEText(body,'plain'))
+    for report_file_name in os.listdir(mail.REPORTS_FOLDER):
+        message.attach(mail.add_attachment(os.path.join(mail.REPORTS_FOLDER, report_file_name)))
+    return message.as_string()
+
+
+def benchmark_mail_message(attachment_sizes_mb, repeat):
+    # Compare building a message with as_string() (and encoding it like sendmail does) with the bytes chunks path
+    import automating_mail_sending_week2 as mail
+
+    reports_folder = tempfile.mkdtemp()
+    mail.REPORTS_FOLDER = reports_folder
+    boundary = "=_daily_report_benchmark"
+    try:
+        for size_mb in attachment_sizes_mb:
+            # One report of the given size
+            for file_name in os.listdir(reports_folder):
+                os.remove(os.path.join(reports_folder, file_name))
+            with open(os.path.join(reports_folder, "report.bin"), "wb") as report_file:
+                report_file.write(os.urandom(int(size_mb * 1024 * 1024)))
+            mail.attachments_fragment_cache.clear()
+
+            def build_as_string():
+                message = create_message_as_string(mail, "sender@example.com", "Name", "name@example.com")
+                # smtplib.sendmail converts the string to bytes before sending it
+                return smtplib._fix_eols(message).encode("ascii")
+
+            def build_chunks():
+                attachments_chunks = mail.get_report_attachments_chunks(boundary)
+                return list(mail.create_message_chunks("sender@example.com", "Name", "name@example.com", attachments_chunks, boundary))
+
+            for name, function in (("as_string", build_as_string), ("bytes_chunks", build_chunks)):
+                seconds, peak_memory = measure(function, repeat)
+                print(f"mail_message attachment={size_mb}MB path={name} "
+                      f"time={seconds * 1000:.2f}ms peak_memory={peak_memory / 1024 / 1024:.2f}MB")
+    finally:
+        shutil.rmtree(reports_folder)
+
+
+def decrypt_caesar_cipher_per_character(encrypted_line, key):
+    # The original character by character decryption of the Caesar cracker, kept as the baseline
+    clear_text = ""
+    for char in encrypted_line:
+        if char.isalpha():
+            start_index = lambda c: ord('A') if c.isupper() else ord('a')
+            step_back = lambda x: x + 26 if x < start_index(char) else x
+            clear_text += chr(step_back(ord(char) - key))
+        else:
+            clear_text += char
+    return clear_text
+
+
+def write_ciphertext_file(file_path, size_bytes):
+    # Write random words of lowercase and uppercase letters, spaces and new lines
+    alphabet = (string.ascii_letters * 4 + " " * 10 + ".,\n").encode()
+    block = bytes(random.choice(alphabet) for _ in range(1024 * 1024))
+    with open(file_path, "wb") as ciphertext_file:
+        remaining = size_bytes
+        while remaining > 0:
+            ciphertext_file.write(block[:remaining])
+            remaining -= len(block)
+
+
+def benchmark_caesar(sizes_kb, per_character_max_kb, repeat):
+    # Compare the decryption of ciphertext files with str.translate, bytes.translate and the per character loop
+    import caesar_cracker_week_4 as caesar
+
+    ciphertext_folder = tempfile.mkdtemp()
+    try:
+        for size_kb in sizes_kb:
+            file_path = os.path.join(ciphertext_folder, f"enc_{size_kb}kb.txt")
+            write_ciphertext_file(file_path, size_kb * 1024)
+
+            def decrypt_str():
+                with open(file_path) as encrypted_file:
+                    return caesar.decrypt_caesar_cipher(encrypted_file.read(), 3)
+
+            def decrypt_bytes():
+                with open(file_path, "rb") as encrypted_file:
+                    return caesar.decrypt_caesar_cipher_bytes(encrypted_file.read(), 3)
+
+            def decrypt_per_character():
+                with open(file_path) as encrypted_file:
+                    return decrypt_caesar_cipher_per_character(encrypted_file.read(), 3)
+
+            engines = [("str_translate", decrypt_str), ("bytes_translate", decrypt_bytes)]
+            # The per character loop takes minutes on big files
+            if size_kb <= per_character_max_kb:
+                engines.append(("per_character", decrypt_per_character))
+            for name, function in engines:
+                seconds, peak_memory = measure(function, repeat)
+                # The peak RSS is the high-water mark of the process: the sizes run from the smallest to the biggest
+                print(f"caesar size={size_kb}KB engine={name} time={seconds * 1000:.2f}ms "
+                      f"throughput={size_kb / 1024 / seconds:.1f}MB/s peak_memory={peak_memory / 1024 / 1024:.2f}MB "
+                      f"peak_rss={peak_rss_mb():.1f}MB")
+            os.remove(file_path)
+    finally:
+        shutil.rmtree(ciphertext_folder)
+
+
+def weather_response(index):
+    # A response of openweathermap with the fields the weather app uses. Every city gets different values
+    return json.dumps({
+        "coord": {"lon": 13.41, "lat": 52.52}, "weather": [{"id": 800, "main": "Clear", "description": f"clear sky {index}", "icon": "01d"}],
+        "base": "stations", "main": {"temp": 20.5 + index, "feels_like": 19.8, "temp_min": 18.1 + index, "temp_max": 22.3 + index,
+                                     "pressure": 1012, "humidity": 40 + index % 60},
+        "visibility": 10000, "wind": {"speed": 3.6, "deg": 250}, "clouds": {"all": index % 100}, "dt": 1700000000,
+        "sys": {"country": "DE", "sunrise": 1699941234, "sunset": 1699974321}, "timezone": 3600, "id": index, "name": f"City {index}", "cod": 200,
+    }).encode()
+
+
+def benchmark_weather_records(record_count, repeat):
+    # Compare the parse cost and the memory of the cached json dicts with the WeatherRecord path
+    import weather_app_week_1 as weather
+
+    responses = [weather_response(index) for index in range(record_count)]
+
+    def parse_json_dicts():
+        # The previous path: decode the bytes to str, then keep the whole dict
+        return [json.loads(response.decode()) for response in responses]
+
+    def parse_records():
+        return [weather.parse_weather_response(response) for response in responses]
+
+    for name, function in (("json_dict", parse_json_dicts), ("weather_record", parse_records)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        seconds_per_record = (time.perf_counter() - start) / repeat / record_count
+
+        # Memory held by the parsed values of all the cities, as they would sit in the cache
+        tracemalloc.start()
+        parsed = function()
+        cached_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del parsed
+        print(f"weather_records records={record_count} path={name} parse={seconds_per_record * 1e6:.2f}us/record "
+              f"cached_memory={cached_memory / 1024 / 1024:.1f}MB ({cached_memory / record_count:.0f} bytes/record)")
+
+
+class SmtpSinkHandler:
+    """
+    aiosmtpd handler that accepts every message and only counts it
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages += 1
+        self.bytes += len(envelope.content)
+        return "250 OK"
+
+
+def benchmark_mail_delivery(recipient_count, attachment_count, attachment_kb, connections):
+    # Send the daily report to recipient_count recipients with attachment_count attachments through a local SMTP sink
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        print("mail_delivery skipped: aiosmtpd is not installed")
+        return
+    import automating_mail_sending_week2 as mail
+
+    work_folder = tempfile.mkdtemp()
+    reports_folder = os.path.join(work_folder, "reports")
+    os.mkdir(reports_folder)
+    for index in range(attachment_count):
+        with open(os.path.join(reports_folder, f"report_{index}.bin"), "wb") as report_file:
+            report_file.write(os.urandom(attachment_kb * 1024))
+    with open(os.path.join(work_folder, "email_list.csv"), "w") as email_list_csv:
+        for index in range(recipient_count):
+            email_list_csv.write(f"Recipient {index},recipient{index}@example.com\n")
+
+    sink = SmtpSinkHandler()
+    port = free_port()
+    controller = Controller(sink, hostname="127.0.0.1", port=port, data_size_limit=None)
+    mail.SMTP_SERVER, mail.SMTP_PORT, mail.SMTP_USE_TLS = "127.0.0.1", port, False
+    mail.SENDER_EMAIL = "reports@example.com"
+    mail.SMTP_CONNECTIONS = connections
+    # Measure the sender, not the rate limit of the real server
+    mail.MAX_MESSAGES_PER_SECOND = 0
+    mail.REPORTS_FOLDER = reports_folder
+    mail.DELIVERY_JOURNAL_FILE = os.path.join(work_folder, "delivery_journal.db")
+    controller.start()
+    try:
+        # email_list.csv is read from the working directory
+        with working_directory(work_folder), capture_metrics(mail.logger) as summaries:
+            mail.send_daily_report_by_email()
+    finally:
+        controller.stop()
+        shutil.rmtree(work_folder)
+
+    print_load_result("mail_delivery", f"recipients={recipient_count} attachments={attachment_count}x{attachment_kb}KB "
+                      f"connections={connections} received={sink.messages}", summaries[-1])
+
+
+def benchmark_ftp_download(file_count, file_kb, workers):
+    # Download file_count partner files from a local FTP server with the worker sessions of the file transfer script
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+    except ImportError:
+        print("ftp_download skipped: pyftpdlib is not installed")
+        return
+    import automating_file_transfer_week_3 as ftp
+
+    work_folder = tempfile.mkdtemp()
+    remote_folder = os.path.join(work_folder, "remote")
+    os.mkdir(remote_folder)
+    content = os.urandom(file_kb * 1024)
+    for index in range(file_count):
+        with open(os.path.join(remote_folder, f"partner_{index:06d}.csv"), "wb") as partner_file:
+            partner_file.write(content)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("benchmark", "benchmark", remote_folder, perm="elr")
+    handler = type("BenchmarkFTPHandler", (FTPHandler,), {"authorizer": authorizer})
+    # Only the errors of the server are printed. With a handler of its own, pyftpdlib doesn't log every command
+    pyftpdlib_logger = logging.getLogger("pyftpdlib")
+    pyftpdlib_logger.setLevel(logging.WARNING)
+    pyftpdlib_logger.addHandler(logging.StreamHandler())
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    server_thread = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+
+    ftp.FTP_SERVER, ftp.PORT = "127.0.0.1", str(server.address[1])
+    ftp.FTP_USER, ftp.FTP_PASS, ftp.FTP_REMOTE_DIRECTORY = "benchmark", "benchmark", "/"
+    ftp.LOCAL_DIRECTORY = os.path.join(work_folder, "local")
+    os.mkdir(ftp.LOCAL_DIRECTORY)
+    ftp.FTP_MANIFEST_FILE = os.path.join(work_folder, "ftp_manifest.json")
+    server_thread.start()
+    try:
+        with capture_metrics(ftp.logger) as summaries:
+            ftp.download_files_by_ftp_to_local_directory(worker_count=workers, incremental=False)
+    finally:
+        server.close_all()
+        shutil.rmtree(work_folder)
+
+    print_load_result("ftp_download", f"files={file_count}x{file_kb}KB workers={workers}", summaries[-1])
+
+
+def weather_icon_png():
+    # A small valid png, the weather app opens the icon with PIL
+    from PIL import Image
+
+    icon_file = BytesIO()
+    Image.new("RGBA", (50, 50), (255, 200, 0, 255)).save(icon_file, "PNG")
+    return icon_file.getvalue()
+
+
+class WeatherStandInHandler(BaseHTTPRequestHandler):
+    """
+    Answer the weather and icon requests like openweathermap, after response_delay seconds
+    """
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, so the connection pool of the app is used
+    response_delay = 0
+    icon_content = b""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/data/2.5/weather":
+            city_name = parse_qs(url.query).get("q", [""])[0]
+            body, content_type = weather_response(sum(city_name.encode()) % 1000), "application/json"
+        elif url.path.startswith("/img/wn/"):
+            body, content_type = self.icon_content, "image/png"
+        else:
+            self.send_error(404)
+            return
+        # Simulate the network and the server time of the real api
+        time.sleep(self.response_delay)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # No access log on the console
+        pass
+
+
+def benchmark_weather_fetch(request_count, city_count, workers, response_delay_ms):
+    # Fetch the weather and icon of request_count lookups over city_count cities from a local openweathermap stand-in
+    import weather_app_week_1 as weather
+
+    handler = type("BenchmarkWeatherHandler", (WeatherStandInHandler,),
+                   {"response_delay": response_delay_ms / 1000, "icon_content": weather_icon_png()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    weather.API_BASE_URL = weather.ICON_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # The lookups cycle through the cities, so the cache serves the repeated ones
+    city_names = [f"City {index % city_count}" for index in range(request_count)]
+    latencies = []
+
+    def timed_fetch(city_name):
+        start = time.perf_counter()
+        weather.fetch_weather(city_name)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(timed_fetch, city_names):
+                pass
+    finally:
+        server.shutdown()
+        server.server_close()
+    seconds = time.perf_counter() - start
+
+    latency_percentiles = " ".join(f"p{percent}={value * 1000:.1f}ms" for percent, value in percentiles(latencies).items())
+    print(f"weather_fetch requests={request_count} cities={city_count} workers={workers} delay={response_delay_ms}ms "
+          f"time={seconds:.2f}s throughput={request_count / seconds:.1f}/s {latency_percentiles} "
+          f"cache={json.dumps(weather.cache_statistics()['weather'])} peak_rss={peak_rss_mb():.1f}MB")
+
+
+def run_all_benchmarks():
+    # Every load test in its own process, so the peak RSS of one does not hide the next one
+    for benchmark in ("mail_delivery", "ftp_download", "weather_fetch", "caesar"):
+        subprocess.run([sys.executable, os.path.abspath(__file__), benchmark], check=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the homework tools")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    mail_parser = subparsers.add_parser("mail_message", help="Message building of the mail sender")
+    mail_parser.add_argument("--attachment-mb", type=float, nargs="+", default=[1, 5, 20])
+    mail_parser.add_argument("--repeat", type=int, default=10)
+
+    caesar_parser = subparsers.add_parser("caesar", help="Decryption engines of the Caesar cracker")
+    caesar_parser.add_argument("--sizes-kb", type=int, nargs="+", default=[1, 1024, 102400])
+    caesar_parser.add_argument("--per-character-max-kb", type=int, default=1024)
+    caesar_parser.add_argument("--repeat", type=int, default=3)
+
+    weather_parser = subparsers.add_parser("weather_records", help="Response parsing and cached records of the weather app")
+    weather_parser.add_argument("--records", type=int, default=100000)
+    weather_parser.add_argument("--repeat", type=int, default=3)
+
+    mail_delivery_parser = subparsers.add_parser("mail_delivery", help="Load test of the daily report mail with a local SMTP sink")
+    mail_delivery_parser.add_argument("--recipients", type=int, default=1000)
+    mail_delivery_parser.add_argument("--attachments", type=int, default=3)
+    mail_delivery_parser.add_argument("--attachment-kb", type=int, default=512)
+    mail_delivery_parser.add_argument("--connections", type=int, default=4)
+
+    ftp_parser = subparsers.add_parser("ftp_download", help="Load test of the ftp download with a local FTP server")
+    ftp_parser.add_argument("--files", type=int, default=2000)
+    ftp_parser.add_argument("--file-kb", type=int, default=64)
+    ftp_parser.add_argument("--workers", type=int, default=4)
+
+    weather_fetch_parser = subparsers.add_parser("weather_fetch", help="Load test of the weather fetch with a local api stand-in")
+    weather_fetch_parser.add_argument("--requests", type=int, default=2000)
+    weather_fetch_parser.add_argument("--cities", type=int, default=500)
+    weather_fetch_parser.add_argument("--workers", type=int, default=8)
+    weather_fetch_parser.add_argument("--delay-ms", type=float, default=20)
+
+    subparsers.add_parser("all", help="Every load test and the caesar benchmark with the default parameters")
+
+    args = parser.parse_args()
+    if args.benchmark == "mail_message":
+        benchmark_mail_message(args.attachment_mb, args.repeat)
+    elif args.benchmark == "caesar":
+        benchmark_caesar(args.sizes_kb, args.per_character_max_kb, args.repeat)
+    elif args.benchmark == "weather_records":
+        benchmark_weather_records(args.records, args.repeat)
+    elif args.benchmark == "mail_delivery":
+        benchmark_mail_delivery(args.recipients, args.attachments, args.attachment_kb, args.connections)
+    elif args.benchmark == "ftp_download":
+        benchmark_ftp_download(args.files, args.file_kb, args.workers)
+    elif args.benchmark == "weather_fetch":
+        benchmark_weather_fetch(args.requests, args.cities, args.workers, args.delay_ms)
+    elif args.benchmark == "all":
+        run_all_benchmarks()
@@ -6,62 +6,274 @@ possible keys for the Caesar cipher, so a computer can easily try all possible d
 this technique a brute-force attack.
 '''
 
+import argparse
+import collections
+import csv
+import glob
+import os
+import string
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def shift_alphabet(alphabet, key):
+    # Rotate the alphabet right by the key, so every letter is replaced by the letter key positions before it
+    return alphabet[-key % 26:] + alphabet[:-key % 26]
+
+def shifted_letters(key):
+    # The decrypted letters for string.ascii_letters (a-z then A-Z)
+    return shift_alphabet(string.ascii_lowercase, key) + shift_alphabet(string.ascii_uppercase, key)
+
+# Translation tables for the 26 keys, built once. DECRYPTION_TABLES[key] shifts every letter a-z A-Z back by the key
+# and keeps the other characters
+DECRYPTION_TABLES = [str.maketrans(string.ascii_letters, shifted_letters(key)) for key in range(26)]
+# The same tables for bytes buffers
+BYTES_DECRYPTION_TABLES = [bytes.maketrans(string.ascii_letters.encode(), shifted_letters(key).encode()) for key in range(26)]
+
+
 def decrypt_caesar_cipher(encrypted_line, key):
-    clear_text = ""
-    for char in encrypted_line:
-        # Decrypt the alpha letters a-z A-Z. 
-        if char.isalpha():
-            # lambda function to return the start index ('a' for lowercase characters or 'A' for upper uppercase characters)
-            start_index = lambda c: ord('A') if c.isupper() else ord('a')
-            # Lambda function to add 26 if the result is less than the start index. So we can have (a <= result <= z) or (A <= result <= Z)
-            step_back = lambda x: x + 26 if x < start_index(char) else x          
-            # Shift back by the key
-            new_char = chr(step_back(ord(char) - key))
-            clear_text+= new_char
+    # Decrypt the alpha letters a-z A-Z with one translate call instead of a loop over the characters
+    return encrypted_line.translate(DECRYPTION_TABLES[key % 26])
 
-        else:
-            # Keep the none-alpha character
-            clear_text += char
+def decrypt_caesar_cipher_bytes(encrypted_data, key):
+    # Decrypt a bytes buffer. The non-ASCII bytes are kept, so UTF-8 text can be decrypted without decoding it
+    return encrypted_data.translate(BYTES_DECRYPTION_TABLES[key % 26])
 
-    return clear_text
+# Relative frequency (percent) of the letters a-z in English text
+ENGLISH_LETTER_FREQUENCIES = [8.167, 1.492, 2.782, 4.253, 12.702, 2.228, 2.015, 6.094, 6.966, 0.153, 0.772, 4.025, 2.406,
+                              6.749, 7.507, 1.929, 0.095, 5.987, 6.327, 9.056, 2.758, 0.978, 2.360, 0.150, 1.974, 0.074]
+# Below this confidence the key is chosen by the user from the brute-force results
+MIN_KEY_CONFIDENCE = 0.5
+# Number of bytes at the start of the file used to find the key. The letter frequencies are stable long before that
+KEY_SAMPLE_SIZE = 1024 * 1024
+# Size of the chunks read, decrypted and written while decrypting the whole file
+DECRYPT_CHUNK_SIZE = 4 * 1024 * 1024
+# In batch mode, files larger than this are split into parts decrypted by different processes
+BATCH_SPLIT_SIZE = 64 * 1024 * 1024
+# The csv report of the batch mode: one row per file with the key, score, output path and timing
+BATCH_REPORT_FILE = "crack_report.csv"
 
-try:
-    # Open the file containing the caesar cipher content
-    with open('enc.txt') as encrypted_file:
-        encrypted_lines = encrypted_file.readlines()
 
-    # Lambda function to return the line with the most characters so we can have enough cipher to brute-force
-    return_max_length_line = lambda lines: max(lines, key=lambda line: len(line))
-    encrypted_line = return_max_length_line(encrypted_lines)
+def count_letters(encrypted_text):
+    # Histogram of the letters a-z, ignoring the case, counted in one pass over a str or bytes text
+    letter_counts = collections.Counter(encrypted_text)
+    if isinstance(encrypted_text, bytes):
+        # Iterating bytes gives the byte values
+        lowercase, uppercase = string.ascii_lowercase.encode(), string.ascii_uppercase.encode()
+    else:
+        lowercase, uppercase = string.ascii_lowercase, string.ascii_uppercase
+    return [letter_counts[lower] + letter_counts[upper] for lower, upper in zip(lowercase, uppercase)]
 
-    # If the max-char-line is small and less than the size of a word, then join all lines 
-    if len(encrypted_line) < 2:
-        encrypted_line = ' '.join(encrypted_lines)
+def score_caesar_keys(letter_histogram):
+    # Chi-squared distance between English and the text decrypted by every key, computed from the histogram only.
+    # Decrypting with a key moves the count of the cipher letter (i + key) to the letter i. The lowest score is the best
+    total_letters = sum(letter_histogram)
+    scores = []
+    for key in range(26):
+        score = 0
+        for letter_index, frequency in enumerate(ENGLISH_LETTER_FREQUENCIES):
+            expected = total_letters * frequency / 100
+            observed = letter_histogram[(letter_index + key) % 26]
+            score += (observed - expected) ** 2 / expected
+        scores.append(score)
+    return scores
 
-        # If the result is still small, then exit the program
-        if len(encrypted_line) < 4:
-            print("The file has no sufficient content to brute-force") 
-            exit(1)
+def crack_caesar_key(encrypted_text):
+    # Return the most likely key and a confidence between 0 (ambiguous) and 1, from how far the best score
+    # is ahead of the second best
+    letter_histogram = count_letters(encrypted_text)
+    if not sum(letter_histogram):
+        return 0, 0.0
+    scores = score_caesar_keys(letter_histogram)
+    best_score, second_best_score = sorted(scores)[:2]
+    confidence = 1 - best_score / second_best_score if second_best_score else 0.0
+    return scores.index(best_score), confidence
 
+def choose_key_by_brute_force(encrypted_line, suggested_key):
     # Brute-force attack from 1 to 25
     for key in range(1,26):
-        # To make the printed text easier to compare, I set the maximum length to 50 
+        # To make the printed text easier to compare, I set the maximum length to 100
         clear_text = decrypt_caesar_cipher(encrypted_line[:100], key)
         # Print the result so the user can choose which one is the correct key
-        print(f"Key: {key}  result: {clear_text}\n")
+        suggestion = "  <- best frequency score" if key == suggested_key else ""
+        print(f"Key: {key}  result: {clear_text}{suggestion}\n")
 
     # Prompt the user for the key or exit 
     key = input("Enter the key value or enter (D)one to exit: ")
     if not key.isnumeric():
         # Exit if the input is not numeric
-        exit(0)
+        return None
+    return int(key)
+
+def read_key_sample(file_path, sample_size=KEY_SAMPLE_SIZE):
+    # Read a bounded prefix of the file for the key detection, so the memory doesn't grow with the file size
+    with open(file_path, 'rb') as encrypted_file:
+        return encrypted_file.read(sample_size)
+
+def decrypt_file_streaming(file_path, output_file, key, chunk_size=DECRYPT_CHUNK_SIZE):
+    # Decrypt the file chunk by chunk into a binary output file. Only one chunk is in memory at a time
+    # and the letters never cross a chunk boundary, because every byte is decrypted on its own
+    with open(file_path, 'rb') as encrypted_file:
+        for chunk in iter(lambda: encrypted_file.read(chunk_size), b""):
+            output_file.write(decrypt_caesar_cipher_bytes(chunk, key))
+
+def crack_file(file_path):
+    # Find the key of one file from its sample. Runs in a worker process
+    start_time = time.perf_counter()
+    key, confidence = crack_caesar_key(read_key_sample(file_path))
+    return key, confidence, time.perf_counter() - start_time
+
+def decrypt_file_range(file_path, output_path, key, offset, length):
+    # Decrypt length bytes starting at offset into the same position of the output file. Runs in a worker process.
+    # The Caesar shift has no state between characters, so the parts of a file can be decrypted independently
+    start_time = time.perf_counter()
+    with open(file_path, 'rb') as encrypted_file, open(output_path, 'r+b') as output_file:
+        encrypted_file.seek(offset)
+        output_file.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = encrypted_file.read(min(DECRYPT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            output_file.write(decrypt_caesar_cipher_bytes(chunk, key))
+            remaining -= len(chunk)
+    return time.perf_counter() - start_time
+
+def find_batch_files(pattern):
+    # A directory means all the files in it, anything else is a glob pattern
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*")
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+def batch_output_paths(file_paths, output_directory):
+    # Keep the path of every file relative to the common directory of the files, so files with the same name
+    # in different directories don't overwrite each other
+    real_output_directory = os.path.realpath(output_directory)
+    for file_path in file_paths:
+        # The output files are created with their final size before decrypting, which would destroy the inputs
+        if os.path.commonpath([real_output_directory, os.path.realpath(file_path)]) == real_output_directory:
+            raise ValueError(f"The output directory {output_directory} contains the input file {file_path}")
+    if not file_paths:
+        return []
+    common_directory = os.path.commonpath([os.path.dirname(os.path.abspath(file_path)) for file_path in file_paths])
+    return [os.path.join(output_directory, os.path.relpath(os.path.abspath(file_path), common_directory))
+            for file_path in file_paths]
+
+def crack_files_in_parallel(file_paths, output_directory, workers=None, report_path=BATCH_REPORT_FILE):
+    # Crack and decrypt many files with a pool of processes and write a csv report. Return the report rows
+    output_paths = batch_output_paths(file_paths, output_directory)
+    os.makedirs(output_directory, exist_ok=True)
+    report_rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Find the keys of all the files in parallel
+        crack_futures = [executor.submit(crack_file, file_path) for file_path in file_paths]
+
+        # Decrypt every file in parts of at most BATCH_SPLIT_SIZE bytes, so the big files use all the processes too
+        decrypt_futures = []
+        for file_path, output_path, crack_future in zip(file_paths, output_paths, crack_futures):
+            try:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                key, confidence, crack_seconds = crack_future.result()
+                file_size = os.path.getsize(file_path)
+                # Create the output file with its final size, so the parts can be written in any order
+                with open(output_path, 'wb') as output_file:
+                    output_file.truncate(file_size)
+                range_futures = [executor.submit(decrypt_file_range, file_path, output_path, key, offset,
+                                                 min(BATCH_SPLIT_SIZE, file_size - offset))
+                                 for offset in range(0, file_size, BATCH_SPLIT_SIZE)]
+                decrypt_futures.append((file_path, output_path, key, confidence, crack_seconds, range_futures, None))
+            except Exception as e:
+                decrypt_futures.append((file_path, output_path, None, None, 0, [], e))
+
+        for file_path, output_path, key, confidence, crack_seconds, range_futures, error in decrypt_futures:
+            seconds = crack_seconds
+            try:
+                # The processing time of the file is the time of its parts in the workers
+                seconds += sum(range_future.result() for range_future in range_futures)
+            except Exception as e:
+                error = e
+            report_rows.append({"file": file_path, "key": key,
+                                "confidence": "" if confidence is None else f"{confidence:.3f}",
+                                "output": output_path, "seconds": f"{seconds:.3f}",
+                                "error": "" if error is None else str(error)})
+
+    with open(report_path, 'w', newline='') as report_file:
+        report_writer = csv.DictWriter(report_file, fieldnames=["file", "key", "confidence", "output", "seconds", "error"])
+        report_writer.writeheader()
+        report_writer.writerows(report_rows)
+
+    return report_rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Crack a file encrypted with the Caesar cipher")
+    parser.add_argument("encrypted_file", nargs="?", default="enc.txt", help="The file to crack (default: enc.txt)")
+    parser.add_argument("--output", help="Write the decrypted file here instead of printing it")
+    parser.add_argument("--interactive", action="store_true",
+                        help="Always choose the key from the brute-force results")
+    parser.add_argument("--batch", metavar="DIRECTORY_OR_GLOB",
+                        help="Crack all the matching files in parallel, without prompting")
+    parser.add_argument("--output-directory", default="decrypted", help="Where the batch mode writes the decrypted files")
+    parser.add_argument("--workers", type=int, help="Number of processes of the batch mode (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if args.batch:
+        file_paths = find_batch_files(args.batch)
+        start_time = time.perf_counter()
+        try:
+            report_rows = crack_files_in_parallel(file_paths, args.output_directory, args.workers)
+        except ValueError as e:
+            print("Error: " + str(e))
+            exit(1)
+        failed = sum(1 for row in report_rows if row["error"])
+        print(f"Cracked {len(report_rows) - failed} of {len(report_rows)} files in {time.perf_counter() - start_time:.1f} seconds. "
+              f"Report: {BATCH_REPORT_FILE}")
+        return
+
+    try:
+        # Read the start of the file containing the caesar cipher content
+        sample_text = read_key_sample(args.encrypted_file).decode(errors="replace")
+        encrypted_lines = sample_text.splitlines() or [""]
+
+        # Lambda function to return the line with the most characters so we can have enough cipher to brute-force
+        return_max_length_line = lambda lines: max(lines, key=lambda line: len(line))
+        encrypted_line = return_max_length_line(encrypted_lines)
+
+        # If the max-char-line is small and less than the size of a word, then join all lines 
+        if len(encrypted_line) < 2:
+            encrypted_line = ' '.join(encrypted_lines)
+
+            # If the result is still small, then exit the program
+            if len(encrypted_line) < 4:
+                print("The file has no sufficient content to brute-force") 
+                exit(1)
+
+        # Score all the keys against the English letter frequencies of the sample
+        key, confidence = crack_caesar_key(sample_text)
+        if args.interactive or confidence < MIN_KEY_CONFIDENCE:
+            # Ambiguous result. Let the user compare the decryptions
+            print(f"Best key by letter frequency: {key}  confidence: {confidence:.2f}\n")
+            key = choose_key_by_brute_force(encrypted_line, key)
+            if key is None:
+                exit(0)
+        else:
+            print(f"Key: {key}  confidence: {confidence:.2f}")
+
+        print("Decrypting the whole file..\n")
+        if args.output:
+            with open(args.output, 'wb') as output_file:
+                decrypt_file_streaming(args.encrypted_file, output_file, key)
+        else:
+            # Write the bytes straight to stdout after the printed text
+            sys.stdout.flush()
+            decrypt_file_streaming(args.encrypted_file, sys.stdout.buffer, key)
+            sys.stdout.buffer.flush()
+
+    except FileNotFoundError as e:
+        print(f"Error: {args.encrypted_file} file is not found")
+    except Exception as e:
+        print("Error: " + str(e))
 
-    print("Decrypting the whole file..\n")
-    for line in encrypted_lines:
-        clear_text = decrypt_caesar_cipher(line, int(key))
-        print(clear_text)
 
-except FileNotFoundError as e:
-    print("Error: enc.txt file is not found in the current directory")
-except Exception as e:
-    print("Error: " + str(e))
+if __name__ == "__main__":
+    main()
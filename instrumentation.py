@@ -0,0 +1,149 @@
+''' Logging and metrics shared by the automation scripts.
+
+setup_logging() puts a QueueHandler on the root logger. The log records are only put in a queue by the hot loops,
+and a QueueListener thread writes them as json lines to the log file and as plain messages to the console.
+JobMetrics counts the items, bytes, retries and latencies of one run of a job and logs them at the end of the run. '''
+
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+
+# Upper bounds (seconds) of the latency histogram buckets. The last bucket counts everything slower
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Number of latencies kept for the percentiles. Longer runs keep a uniform random sample of this size
+MAX_LATENCY_SAMPLES = 10000
+
+# The attributes of every LogRecord. The other attributes come from the "extra" argument of the log call
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a log record as one json line. The "extra" fields of the log call are added to the json object
+    """
+
+    def format(self, record):
+        log_entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                log_entry[key] = value
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+
+def setup_logging(log_file, level=logging.INFO):
+    # Log to the file (json lines) and to the console without blocking the logging threads. Return the listener
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    # Write the queued records before the interpreter exits
+    atexit.register(listener.stop)
+
+    return listener
+
+
+def percentiles(values, percents=(50, 95, 99)):
+    # Nearest-rank percentiles of the values. Empty if there are no values
+    if not values:
+        return {}
+    sorted_values = sorted(values)
+    return {percent: sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))] for percent in percents}
+
+
+class JobMetrics:
+    """
+    Counters of one run of a job. The methods can be called from many threads
+    """
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.items = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_samples = []
+        # Other counters, e.g. skipped or moved files
+        self.counters = {}
+
+    def record_item(self, latency_seconds, byte_count=0):
+        # One item (file, message) is done
+        with self.lock:
+            self.items += 1
+            self.bytes += byte_count
+            self.total_latency += latency_seconds
+            self.max_latency = max(self.max_latency, latency_seconds)
+            self.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, latency_seconds)] += 1
+            # Reservoir sampling: every latency has the same chance to be in the sample
+            if len(self.latency_samples) < MAX_LATENCY_SAMPLES:
+                self.latency_samples.append(latency_seconds)
+            else:
+                sample_index = random.randrange(self.items)
+                if sample_index < MAX_LATENCY_SAMPLES:
+                    self.latency_samples[sample_index] = latency_seconds
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def increment(self, counter_name, amount=1):
+        with self.lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    def summary(self):
+        with self.lock:
+            seconds = time.monotonic() - self.start_time
+            bucket_names = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+            return {
+                "job": self.job_name,
+                "seconds": round(seconds, 3),
+                "items": self.items,
+                "items_per_second": round(self.items / seconds, 3) if seconds else 0,
+                "bytes": self.bytes,
+                "bytes_per_second": round(self.bytes / seconds) if seconds else 0,
+                "retries": self.retries,
+                "failures": self.failures,
+                "average_latency": round(self.total_latency / self.items, 4) if self.items else 0,
+                "max_latency": round(self.max_latency, 4),
+                **{f"latency_p{percent}": round(value, 4) for percent, value in percentiles(self.latency_samples).items()},
+                "latency_histogram": dict(zip(bucket_names, self.latency_histogram)),
+                **self.counters,
+            }
+
+    def log_summary(self, logger):
+        # Dump the metrics of the run as one structured log record
+        summary = self.summary()
+        logger.info(f"Metrics of {self.job_name}: {summary['items']} items, {summary['bytes']} bytes "
+                    f"in {summary['seconds']} seconds", extra={"metrics": summary})
+        return summary
@@ -0,0 +1,151 @@
+''' Runner for the daily jobs of the automation scripts.
+
+Instead of waking up every second to ask the schedule library if a job is due, the runner sleeps until the next
+deadline. The jobs run in a pool of threads, so a slow job doesn't delay the others, and a job never runs twice at
+the same time. A job that asks to stop the script (e.g. wrong credentials) is disabled and the other jobs keep
+running. Run it directly to run the jobs of both automation scripts in one process:
+
+    python job_runner.py '''
+
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Maximum seconds of one sleep. Waking up once an hour keeps the deadlines right after the system clock changes
+MAX_SLEEP_SECONDS = 3600
+# A run that starts later than this after its scheduled time (e.g. the computer was sleeping) is skipped
+DEFAULT_MISFIRE_GRACE_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A function that runs every day at a time "HH:MM"
+    """
+
+    def __init__(self, name, function, at_time, misfire_grace_seconds, catch_up):
+        self.name = name
+        self.function = function
+        self.at_time = datetime.datetime.strptime(at_time, "%H:%M").time()
+        # None: a late run always runs
+        self.misfire_grace_seconds = misfire_grace_seconds
+        # Run today's missed run when the runner starts after the scheduled time
+        self.catch_up = catch_up
+        self.running = False
+
+    def next_run_after(self, moment):
+        # The first scheduled time after the moment
+        next_run = datetime.datetime.combine(moment.date(), self.at_time)
+        if next_run <= moment:
+            next_run += datetime.timedelta(days=1)
+        return next_run
+
+    def first_run(self, now):
+        if self.catch_up:
+            # Today's time even if it has passed. The misfire grace decides if it still runs
+            return datetime.datetime.combine(now.date(), self.at_time)
+        return self.next_run_after(now)
+
+
+class JobRunner:
+    """
+    Sleep until the next job is due and run it in the thread pool
+    """
+
+    def __init__(self, max_workers=4):
+        # (next run time, sequence number, job). The sequence number orders the jobs due at the same time
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stopped = False
+        self.exit_code = 0
+
+    def every_day_at(self, at_time, function, name=None, misfire_grace_seconds=DEFAULT_MISFIRE_GRACE_SECONDS, catch_up=False):
+        job = Job(name or function.__name__, function, at_time, misfire_grace_seconds, catch_up)
+        with self.condition:
+            heapq.heappush(self.deadlines, (job.first_run(datetime.datetime.now()), next(self.sequence), job))
+            # Wake up the runner, the new job may be due before the one it is waiting for
+            self.condition.notify()
+        return job
+
+    def run_forever(self):
+        # Run the jobs until stop() is called. Return the exit code requested by a job, 0 otherwise
+        with self.condition:
+            while not self.stopped:
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+                next_run, _, job = self.deadlines[0]
+                now = datetime.datetime.now()
+                if next_run > now:
+                    # Sleep until the deadline. A new job or stop() wakes the runner up earlier
+                    self.condition.wait(min((next_run - now).total_seconds(), MAX_SLEEP_SECONDS))
+                    continue
+
+                heapq.heappop(self.deadlines)
+                lateness = (now - next_run).total_seconds()
+                if job.misfire_grace_seconds is not None and lateness > job.misfire_grace_seconds:
+                    logger.warning(f"Skipping the {next_run} run of {job.name}: it is {lateness:.0f} seconds late")
+                else:
+                    self.start(job)
+                # The missed runs are not repeated. The next run is the next scheduled time from now
+                heapq.heappush(self.deadlines, (job.next_run_after(now), next(self.sequence), job))
+
+        self.executor.shutdown(wait=True)
+        return self.exit_code
+
+    def start(self, job):
+        if job.running:
+            # The previous run is still busy. Don't run the job twice at the same time
+            logger.warning(f"Skipping {job.name}: the previous run has not finished")
+            return
+        job.running = True
+        self.executor.submit(self.run_job, job)
+
+    def run_job(self, job):
+        logger.info(f"Running {job.name}")
+        try:
+            job.function()
+        except SystemExit as e:
+            # The job asked to stop the script (e.g. wrong credentials). Only this job stops running
+            logger.error(f"{job.name} is disabled after exiting with exit code {e.code}")
+            self.disable(job, e.code)
+        except Exception as e:
+            logger.error(f"{job.name} failed: {e}")
+        finally:
+            job.running = False
+
+    def disable(self, job, exit_code):
+        # Remove the job from the schedule. The runner stops with the job's exit code when no job is left
+        with self.condition:
+            self.exit_code = exit_code
+            self.deadlines = [deadline for deadline in self.deadlines if deadline[2] is not job]
+            heapq.heapify(self.deadlines)
+            if not self.deadlines:
+                self.stopped = True
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+if __name__ == "__main__":
+    import automating_file_transfer_week_3
+    import automating_mail_sending_week2
+    from instrumentation import setup_logging
+
+    # Log events of both scripts to jobs.log file as json lines and to the console, from a background thread
+    setup_logging('jobs.log')
+
+    runner = JobRunner()
+    automating_file_transfer_week_3.register_jobs(runner)
+    automating_mail_sending_week2.register_jobs(runner)
+    exit(runner.run_forever())
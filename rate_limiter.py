@@ -0,0 +1,26 @@
+''' Rate limiter shared by the scripts that call rate limited services (the SMTP server, the weather api). '''
+
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Allow at most max_calls_per_second calls of wait() per second, shared by all the threads
+    """
+
+    def __init__(self, max_calls_per_second):
+        self.interval = 1 / max_calls_per_second if max_calls_per_second else 0
+        self.next_call_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        # Reserve the next free time slot and sleep outside the lock until it comes
+        with self.lock:
+            now = time.monotonic()
+            sleep_time = self.next_call_time - now
+            self.next_call_time = max(self.next_call_time, now) + self.interval
+        if sleep_time > 0:
+            time.sleep(sleep_time)
@@ -0,0 +1,262 @@
+''' Combined mode of the file transfer and the mail scripts.
+
+The two scripts run at fixed times, so a partner file that lands after the mail job waits a day to reach the clients.
+The pipeline runs both jobs as one chain of stages connected by bounded asyncio queues:
+
+    ftp ingest (downloads and publishes the partner files)
+        -> batching (groups the files that arrive close together)
+            -> delivery (mails the batch to every recipient of email_list.csv)
+
+A file is delivered as soon as its batch is complete, while the next files are still being downloaded. When the
+delivery is slower than the ingest, the full queues make the ingest wait instead of piling up files in memory.
+The published files stay in a pending list of the delivery journal until every recipient got them, so the reports
+of a failed delivery (e.g. the SMTP server is down) are delivered by the next run.
+Run it directly to run the pipeline every day instead of the two separate jobs:
+
+    python report_distribution_pipeline.py '''
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import automating_file_transfer_week_3 as file_transfer
+import automating_mail_sending_week2 as mail_sending
+from job_runner import JobRunner
+from instrumentation import JobMetrics, setup_logging
+
+
+# Published files waiting to be batched. A full queue makes the ftp download wait
+PUBLISHED_QUEUE_SIZE = 16
+# Batches waiting to be delivered
+DELIVERY_QUEUE_SIZE = 2
+# A batch is delivered when no new file was published for this many seconds
+BATCH_WINDOW_SECONDS = 30
+# Maximum number of reports attached to one mail
+MAX_REPORTS_PER_DELIVERY = 20
+# A batch that some recipients still didn't get after this many runs is dropped from the pending reports
+MAX_DELIVERY_RUNS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class PendingReports:
+    """
+    Durable list of the published reports that are not delivered to every recipient yet, kept in the delivery
+    journal database. A report gets the run_id of its batch before the batch is delivered, so a failed delivery
+    is retried as the same batch and the recipients that already got it are skipped
+    """
+
+    def __init__(self, journal_path):
+        self.lock = threading.Lock()
+        # The mover thread adds the reports, the event loop removes them. The lock serializes the access
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pending_reports ("
+                                "report_path TEXT PRIMARY KEY, published_at REAL NOT NULL, "
+                                "run_id TEXT, delivery_runs INTEGER NOT NULL DEFAULT 0)")
+        self.connection.commit()
+
+    def add(self, report_path, published_at):
+        # A report published again is a new version. It is batched again
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pending_reports VALUES (?, ?, NULL, 0)", (report_path, published_at))
+
+    def assign_batch(self, report_paths, run_id):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE pending_reports SET run_id = ? WHERE report_path = ?",
+                                        [(run_id, report_path) for report_path in report_paths])
+
+    def record_failed_run(self, run_id):
+        # Return the number of runs that failed to deliver the batch
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE pending_reports SET delivery_runs = delivery_runs + 1 WHERE run_id = ?", (run_id,))
+            return self.connection.execute("SELECT MAX(delivery_runs) FROM pending_reports WHERE run_id = ?", (run_id,)).fetchone()[0] or 0
+
+    def remove(self, report_paths):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM pending_reports WHERE report_path = ?", [(report_path,) for report_path in report_paths])
+
+    def load(self):
+        # Return the reports left by the previous runs: [(path, published_at)] of the reports without a batch,
+        # and [(run_id, [(path, published_at)])] of the batches that were not delivered to every recipient
+        with self.lock:
+            rows = self.connection.execute("SELECT report_path, published_at, run_id FROM pending_reports "
+                                           "ORDER BY published_at").fetchall()
+        missing = [report_path for report_path, _, _ in rows if not os.path.exists(report_path)]
+        if missing:
+            logger.warning(f"Dropping {len(missing)} pending reports that are no longer in the shared directory")
+            self.remove(missing)
+        unbatched = []
+        batches = {}
+        for report_path, published_at, run_id in rows:
+            if report_path in missing:
+                continue
+            if run_id is None:
+                unbatched.append((report_path, published_at))
+            else:
+                batches.setdefault(run_id, []).append((report_path, published_at))
+        return unbatched, list(batches.items())
+
+    def close(self):
+        self.connection.close()
+
+
+def delivery_run_id(report_paths):
+    # Key of the delivery journal for a batch: the date and the published versions of the reports. Running the
+    # pipeline again does not mail the same reports twice to a recipient, but a changed report is mailed again
+    digest = hashlib.sha256()
+    for report_path in sorted(report_paths):
+        report_stat = os.stat(report_path)
+        digest.update(f"{os.path.basename(report_path)}:{report_stat.st_size}:{report_stat.st_mtime_ns}\n".encode())
+    return f"{datetime.date.today().isoformat()}-pipeline-{digest.hexdigest()[:16]}"
+
+
+async def ingest_partner_files(published_queue, pending_reports, replayed_reports):
+    # Queue the reports published but not batched by the previous runs, then run the file transfer task in a thread.
+    # Every published file is put in the queue with its publish time
+    loop = asyncio.get_running_loop()
+
+    def on_published(published_path):
+        # Called from the mover thread. The report is recorded before it is queued, so a crash doesn't lose it
+        published_at = time.time()
+        pending_reports.add(published_path, published_at)
+        # Waiting for the put is the backpressure on the ftp download
+        asyncio.run_coroutine_threadsafe(published_queue.put((published_path, published_at)), loop).result()
+
+    try:
+        for published_file in replayed_reports:
+            await published_queue.put(published_file)
+        await asyncio.to_thread(file_transfer.transfer_daily_files_from_ftp_to_local_network, on_published)
+    finally:
+        # Tell the batching stage that no more files are coming
+        await published_queue.put(None)
+
+
+async def collect_report_batches(published_queue, delivery_queue, replayed_batches):
+    # Group the published files into batches, so a burst of partner files is sent as one mail to each recipient.
+    # The queued batches are (run_id, batch). The batches of the previous runs keep their run_id
+    for replayed_batch in replayed_batches:
+        await delivery_queue.put(replayed_batch)
+
+    batch = []
+    while True:
+        try:
+            # Wait without a timeout while there is nothing to deliver
+            published_file = await asyncio.wait_for(published_queue.get(), BATCH_WINDOW_SECONDS if batch else None)
+        except asyncio.TimeoutError:
+            # No new file during the window. Deliver what arrived so far
+            await delivery_queue.put((None, batch))
+            batch = []
+            continue
+
+        if published_file is None:
+            if batch:
+                await delivery_queue.put((None, batch))
+            await delivery_queue.put(None)
+            return
+
+        batch.append(published_file)
+        if len(batch) >= MAX_REPORTS_PER_DELIVERY:
+            await delivery_queue.put((None, batch))
+            batch = []
+
+
+async def deliver_report_batches(delivery_queue, pending_reports, metrics):
+    # Mail every batch with the mail task, in a thread. The batches are delivered one after the other
+    exit_request = None
+    while True:
+        queued_batch = await delivery_queue.get()
+        if queued_batch is None:
+            break
+        # Drain the queue without sending after a fatal error (e.g. wrong credentials), so the ingest can finish.
+        # The reports stay pending for the next run
+        if exit_request is not None:
+            continue
+
+        run_id, batch = queued_batch
+        report_paths = [report_path for report_path, _ in batch]
+        report_names = ", ".join(os.path.basename(report_path) for report_path in report_paths)
+        logger.info(f"Delivering {len(report_paths)} reports: {report_names}")
+        try:
+            if run_id is None:
+                run_id = delivery_run_id(report_paths)
+                # Remember the batch, so a failed delivery is retried with the same journal key
+                pending_reports.assign_batch(report_paths, run_id)
+            # Other systems consume the share, so a report may be moved away after it was delivered
+            report_sizes = [os.path.getsize(report_path) for report_path in report_paths]
+            failures = await asyncio.to_thread(mail_sending.send_daily_report_by_email, report_paths, run_id)
+        except SystemExit as e:
+            logger.error("The delivery stopped the pipeline. The remaining reports are mailed by the next run")
+            exit_request = e
+            continue
+        except Exception as e:
+            # E.g. a report was removed from the share. The next batches are still delivered
+            logger.error(f"Delivering the reports failed: {e}")
+            metrics.record_failure()
+            continue
+
+        if failures:
+            metrics.record_failure()
+            failed_runs = pending_reports.record_failed_run(run_id)
+            if failed_runs >= MAX_DELIVERY_RUNS:
+                logger.error(f"Giving up on {report_names}: {failures} recipients did not get them after {failed_runs} runs")
+                pending_reports.remove(report_paths)
+            else:
+                logger.error(f"{failures} recipients did not get {report_names}. The next run delivers them again")
+            continue
+
+        pending_reports.remove(report_paths)
+        metrics.increment("deliveries")
+        for (_, published_at), report_size in zip(batch, report_sizes):
+            # Latency from publishing the file to handing its mails to the server, across the runs
+            metrics.record_item(time.time() - published_at, report_size)
+
+    if exit_request is not None:
+        raise exit_request
+
+
+async def distribute_reports():
+    metrics = JobMetrics("distribute_reports")
+    published_queue = asyncio.Queue(maxsize=PUBLISHED_QUEUE_SIZE)
+    delivery_queue = asyncio.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+    pending_reports = PendingReports(mail_sending.DELIVERY_JOURNAL_FILE)
+    try:
+        # The reports that the previous runs published but didn't deliver go first
+        replayed_reports, replayed_batches = pending_reports.load()
+        if replayed_reports or replayed_batches:
+            logger.info(f"Delivering {len(replayed_reports) + sum(len(batch) for _, batch in replayed_batches)} "
+                        f"reports left by the previous runs")
+        await asyncio.gather(
+            ingest_partner_files(published_queue, pending_reports, replayed_reports),
+            collect_report_batches(published_queue, delivery_queue, replayed_batches),
+            deliver_report_batches(delivery_queue, pending_reports, metrics),
+        )
+    finally:
+        pending_reports.close()
+        # Dump the metrics of the run to the log
+        metrics.log_summary(logger)
+
+
+def run_report_distribution_pipeline():
+    logger.info("Pipeline has Started")
+    asyncio.run(distribute_reports())
+    logger.info("Pipeline finished")
+
+
+def register_jobs(runner):
+    # Run the pipeline every day at the time of the file transfer. A run of today missed by less than the runner's misfire grace (an hour) is caught up
+    runner.every_day_at("19:46", run_report_distribution_pipeline, catch_up=True)
+
+
+if __name__ == "__main__":
+    # Log events to pipeline.log file as json lines and to the console, from a background thread
+    setup_logging('pipeline.log')
+
+    # Keep the script running. The runner sleeps until the pipeline is due
+    runner = JobRunner()
+    register_jobs(runner)
+    exit(runner.run_forever())
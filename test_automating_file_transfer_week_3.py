@@ -0,0 +1,166 @@
+''' Regression tests of the resumable download and the manifest journal of the file transfer script, against a
+local pyftpdlib server (pip install pytest pyftpdlib):
+
+    python -m pytest test_automating_file_transfer_week_3.py
+
+pyftpdlib changes the working directory of the process, so every path given to the script is absolute. '''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("pyftpdlib")
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+import automating_file_transfer_week_3 as file_transfer
+
+
+REMOTE_CONTENT = b"0123456789" * 1000
+
+
+class HashHandler(FTPHandler):
+    """
+    Answer XSHA256 like the servers that can compute the sha256 of a file
+    """
+
+    proto_cmds = dict(FTPHandler.proto_cmds, XSHA256=dict(perm="r", auth=True, arg=True, help="Syntax: XSHA256 <SP> file-name"))
+
+    def ftp_FEAT(self, line):
+        self.push("211-Features supported:\r\n XSHA256\r\n MLST type*;size*;modify*;\r\n REST STREAM\r\n211 End FEAT.\r\n")
+
+    def ftp_XSHA256(self, path):
+        with open(path, "rb") as remote_file:
+            self.respond("213 " + hashlib.sha256(remote_file.read()).hexdigest())
+
+
+def start_ftp_server(remote_directory, handler):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "password", str(remote_directory), perm="elr")
+    server = ThreadedFTPServer(("127.0.0.1", 0), type("Handler", (handler,), {"authorizer": authorizer}))
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def ftp_connection(request, tmp_path, monkeypatch):
+    # A connection to a local server sharing remote/data.csv. Parametrize with HashHandler for a server with XSHA256
+    handler = getattr(request, "param", FTPHandler)
+    # Keep pyftpdlib from configuring the logging of the process
+    logging.getLogger("pyftpdlib").addHandler(logging.NullHandler())
+    monkeypatch.chdir(tmp_path)
+    remote_directory = tmp_path / "remote"
+    remote_directory.mkdir()
+    (remote_directory / "data.csv").write_bytes(REMOTE_CONTENT)
+    local_directory = tmp_path / "local"
+    local_directory.mkdir()
+
+    server = start_ftp_server(remote_directory, handler)
+    monkeypatch.setattr(file_transfer, "FTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(file_transfer, "PORT", str(server.address[1]))
+    monkeypatch.setattr(file_transfer, "FTP_USER", "user")
+    monkeypatch.setattr(file_transfer, "FTP_PASS", "password")
+    monkeypatch.setattr(file_transfer, "FTP_REMOTE_DIRECTORY", "/")
+    monkeypatch.setattr(file_transfer, "LOCAL_DIRECTORY", str(local_directory))
+    connection = file_transfer.open_ftp_connection()
+    yield connection
+    file_transfer.close_ftp_connection(connection)
+    server.close_all()
+
+
+def write_part(part_content, part_info):
+    part_path = os.path.join(file_transfer.LOCAL_DIRECTORY, "data.csv.part")
+    with open(part_path, "wb") as part_file:
+        part_file.write(part_content)
+    if part_info is not None:
+        with open(part_path + ".json", "w") as part_info_file:
+            json.dump(part_info, part_info_file)
+
+
+def read_local_file():
+    with open(os.path.join(file_transfer.LOCAL_DIRECTORY, "data.csv"), "rb") as local_file:
+        return local_file.read()
+
+
+def test_resume_part_of_the_same_version(ftp_connection):
+    metadata = file_transfer.list_remote_files_with_metadata(ftp_connection)["data.csv"]
+    # The part is not a prefix of the remote file, so the result shows that it was resumed and not downloaded again
+    write_part(b"x" * 4000, metadata)
+
+    file_size, sha256 = file_transfer.download_file(ftp_connection, "data.csv", metadata["size"], metadata["modify"])
+
+    expected = b"x" * 4000 + REMOTE_CONTENT[4000:]
+    assert read_local_file() == expected
+    assert (file_size, sha256) == (len(expected), hashlib.sha256(expected).hexdigest())
+    assert sorted(os.listdir(file_transfer.LOCAL_DIRECTORY)) == ["data.csv"]
+
+
+@pytest.mark.parametrize("part_info", [None, {"size": len(REMOTE_CONTENT), "modify": "19990101000000"}])
+def test_discard_part_of_another_version(ftp_connection, part_info):
+    metadata = file_transfer.list_remote_files_with_metadata(ftp_connection)["data.csv"]
+    write_part(b"x" * 4000, part_info)
+
+    file_transfer.download_file(ftp_connection, "data.csv", metadata["size"], metadata["modify"])
+
+    assert read_local_file() == REMOTE_CONTENT
+    assert sorted(os.listdir(file_transfer.LOCAL_DIRECTORY)) == ["data.csv"]
+
+
+def test_size_mismatch(ftp_connection):
+    metadata = file_transfer.list_remote_files_with_metadata(ftp_connection)["data.csv"]
+
+    # Shorter than listed: the part is kept for the next attempt
+    with pytest.raises(file_transfer.IncompleteDownloadError):
+        file_transfer.download_file(ftp_connection, "data.csv", metadata["size"] + 10, metadata["modify"])
+    assert sorted(os.listdir(file_transfer.LOCAL_DIRECTORY)) == ["data.csv.part", "data.csv.part.json"]
+
+    # Longer than listed: the part doesn't belong to the listed file and is removed
+    with pytest.raises(file_transfer.IncompleteDownloadError):
+        file_transfer.download_file(ftp_connection, "data.csv", metadata["size"] - 10, metadata["modify"])
+    assert "data.csv.part" not in os.listdir(file_transfer.LOCAL_DIRECTORY)
+
+
+@pytest.mark.parametrize("ftp_connection", [HashHandler], indirect=True)
+def test_sha256_mismatch(ftp_connection):
+    metadata = file_transfer.list_remote_files_with_metadata(ftp_connection)["data.csv"]
+    assert ftp_connection.sha256_command == "XSHA256"
+    # A corrupt part of the same version is resumed, then rejected by the checksum of the server
+    write_part(b"x" * 4000, metadata)
+
+    with pytest.raises(file_transfer.IncompleteDownloadError):
+        file_transfer.download_file(ftp_connection, "data.csv", metadata["size"], metadata["modify"])
+    assert "data.csv.part" not in os.listdir(file_transfer.LOCAL_DIRECTORY)
+
+    # The next attempt downloads the whole file
+    file_transfer.download_file(ftp_connection, "data.csv", metadata["size"], metadata["modify"])
+    assert read_local_file() == REMOTE_CONTENT
+
+
+def test_manifest_replays_journal_with_cut_line(tmp_path):
+    manifest_path = str(tmp_path / "ftp_manifest.json")
+    with open(manifest_path, "w") as manifest_file:
+        json.dump({"a.csv": {"size": 1, "modify": "20240101000000", "sha256": "a"}}, manifest_file)
+    # An interrupted run recorded b.csv and was cut while writing c.csv
+    with open(manifest_path + ".journal", "w") as journal_file:
+        journal_file.write(json.dumps(["b.csv", {"size": 2, "modify": "20240102000000", "sha256": "b"}]) + "\n")
+        journal_file.write('["c.csv", {"size": 3, "mod')
+
+    manifest = file_transfer.DownloadManifest(manifest_path)
+    assert sorted(manifest.entries) == ["a.csv", "b.csv"]
+    assert manifest.is_unchanged("b.csv", {"size": 2, "modify": "20240102000000"})
+    manifest.record("d.csv", {"size": 4, "modify": "20240104000000"}, "d")
+    manifest.journal_file.close()
+
+    # The entry recorded after the cut line is not lost when the journal is replayed again
+    manifest = file_transfer.DownloadManifest(manifest_path)
+    assert sorted(manifest.entries) == ["a.csv", "b.csv", "d.csv"]
+    manifest.close()
+
+    assert not os.path.exists(manifest_path + ".journal")
+    with open(manifest_path) as manifest_file:
+        assert sorted(json.load(manifest_file)) == ["a.csv", "b.csv", "d.csv"]
@@ -1,11 +1,29 @@
 from io import BytesIO
 from tkinter import *
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image, ImageTk
 import json
 import datetime
+import argparse
+import csv
+import sys
+import contextlib
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, astuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 # To use decorator for exception handling
 from functools import wraps
+from rate_limiter import RateLimiter
+# orjson parses the response bytes faster than the json module. It is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # Put here the openweathermap API's token
@@ -13,6 +31,168 @@ API_KEY = ""
 
 # For temperature in Celsius use units=metric
 API_UNITS = "metric"
+# Addresses of the openweathermap API and icons. A local stand-in server can be used for testing
+API_BASE_URL = "https://api.openweathermap.org"
+ICON_BASE_URL = "https://openweathermap.org"
+
+# Seconds a weather response is served from the cache before asking the API again
+WEATHER_CACHE_TTL = 600
+# Maximum number of cities kept in the cache. The least recently used city is removed first
+WEATHER_CACHE_SIZE = 256
+# There are only a few dozen weather icons and they never change
+ICON_CACHE_SIZE = 64
+# The caches are saved in this file when the app is closed, so the next start is warm. None to disable
+CACHE_FILE = "weather_cache.json"
+# Connect and read timeouts (seconds) of the requests to openweathermap
+REQUEST_TIMEOUT = (3.05, 10)
+# Milliseconds between two checks of the main loop for the result of the background fetch
+RESULT_POLL_INTERVAL = 50
+# Maximum number of keep-alive connections to openweathermap kept by the shared session
+HTTP_POOL_SIZE = 16
+# Parallel requests of the bulk mode
+BULK_MAX_WORKERS = 16
+# Requests per second of the bulk mode. Keep it under the limit of the openweathermap plan
+BULK_MAX_REQUESTS_PER_SECOND = 10
+# The fields of a bulk mode row
+BULK_FIELDS = ["city", "status", "temp", "min_temp", "max_temp", "pressure", "humidity", "cloudy", "description", "icon_id", "error"]
+
+
+class TTLCache:
+    """
+    LRU cache with a maximum size whose entries expire ttl seconds after they were stored (never if ttl is None).
+    It counts the hits and misses
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (time stored, value), ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                # Expired
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, stored_at=None):
+        with self.lock:
+            self.entries[key] = (time.time() if stored_at is None else stored_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def statistics(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+@dataclass(frozen=True)
+class WeatherRecord:
+    """
+    The weather values shown for a city, plus the id of its weather icon. Using __slots__ keeps the cached records small
+    """
+
+    __slots__ = ("temp", "min_temp", "max_temp", "pressure", "humidity", "cloudy", "description", "icon_id")
+    temp: float
+    min_temp: float
+    max_temp: float
+    pressure: int
+    humidity: int
+    cloudy: int
+    description: str
+    icon_id: str
+
+    @classmethod
+    def from_json_dict(cls, weather_json_dict):
+        # Extract the required values from the dictionary of a successful response
+        return cls(
+            temp=weather_json_dict['main']['temp'],
+            min_temp=weather_json_dict['main']['temp_min'],
+            max_temp=weather_json_dict['main']['temp_max'],
+            pressure=weather_json_dict['main']['pressure'],
+            humidity=weather_json_dict['main']['humidity'],
+            cloudy=weather_json_dict['clouds']['all'],
+            description=weather_json_dict['weather'][0]['description'],
+            icon_id=weather_json_dict['weather'][0]['icon'],
+        )
+
+
+# Weather records by normalized city name and units, and icon bytes by icon id
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL)
+icon_cache = TTLCache(ICON_CACHE_SIZE)
+
+# One session for all the requests, so the TCP and TLS connections are reused instead of opened for every request
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE))
+http_session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE))
+
+# The network requests run in background threads, so the window keeps responding. Only the main thread touches the widgets
+fetch_executor = ThreadPoolExecutor(max_workers=4)
+# The fetch of the last click. The results of the older fetches are dropped
+current_fetch = None
+
+
+def weather_cache_key(city_name, units=None):
+    # " Berlin" and "berlin" are the same city
+    return f"{city_name.strip().casefold()}|{units or API_UNITS}"
+
+def cache_statistics():
+    return {"weather": weather_cache.statistics(), "icons": icon_cache.statistics()}
+
+def save_caches(cache_file=CACHE_FILE):
+    # Save both caches as json. The icon bytes are stored in base64
+    if cache_file is None:
+        return
+    with weather_cache.lock, icon_cache.lock:
+        cache_content = {
+            "weather": [[key, stored_at, astuple(value)] for key, (stored_at, value) in weather_cache.entries.items()],
+            "icons": [[key, stored_at, base64.b64encode(value).decode()] for key, (stored_at, value) in icon_cache.entries.items()],
+        }
+    # Write to a temporary file first, so a crash never leaves half of a cache file
+    with open(cache_file + ".tmp", "w") as saved_cache:
+        json.dump(cache_content, saved_cache)
+    os.replace(cache_file + ".tmp", cache_file)
+
+def load_caches(cache_file=CACHE_FILE):
+    # Fill the caches from the saved file. The expired weather entries are dropped by the next get
+    if cache_file is None or not os.path.exists(cache_file):
+        return
+    try:
+        with open(cache_file) as saved_cache:
+            cache_content = json.load(saved_cache)
+    except (OSError, ValueError):
+        # A broken cache file only means a cold start
+        return
+    if not isinstance(cache_content, dict):
+        return
+    for entry in cache_content.get("weather", []):
+        try:
+            key, stored_at, value = entry
+            # The cache files of older versions keep the whole json dict of the response
+            weather_record = WeatherRecord.from_json_dict(value) if isinstance(value, dict) else WeatherRecord(*value)
+        except (TypeError, KeyError, IndexError, ValueError):
+            # An entry we can't read is fetched again when it is needed
+            continue
+        weather_cache.put(key, weather_record, stored_at)
+    for entry in cache_content.get("icons", []):
+        try:
+            key, stored_at, value = entry
+            icon_content = base64.b64decode(value)
+        except (TypeError, ValueError):
+            continue
+        icon_cache.put(key, icon_content, stored_at)
 
 def catch_all_error_and_write_on_widget(f):
     """
@@ -42,44 +222,124 @@ def catch_all_error_and_write_on_widget(f):
             
     return decorated
 
-@catch_all_error_and_write_on_widget
-def get_weather_json_dict_from_api(city_name):
-
+def parse_weather_response(response_content):
+    # Parse the response bytes straight into a WeatherRecord, without decoding them to a str first.
+    # Return None if the city is not found: {"cod":"404","message":"city not found"}. Raise for any other error
+    weather_json_dict = orjson.loads(response_content) if orjson is not None else json.loads(response_content)
+    if str(weather_json_dict.get('cod')) == "404":
+        return None
+    if weather_json_dict.get('cod') != 200:
+        raise ValueError(f"Weather api error {weather_json_dict.get('cod')}: {weather_json_dict.get('message')}")
+    return WeatherRecord.from_json_dict(weather_json_dict)
+
+def get_weather_record_from_api(city_name, rate_limiter=None):
+    # Runs in a background thread. The errors are raised to the main thread by show_weather_result.
+    # Return None if the city is not found. The rate limiter only counts the requests sent to the api
+
+    # Serve the cities looked up in the last WEATHER_CACHE_TTL seconds from the cache
+    cache_key = weather_cache_key(city_name)
+    weather_record = weather_cache.get(cache_key)
+    if weather_record is not None:
+        return weather_record
+
+    if rate_limiter is not None:
+        rate_limiter.wait()
     # Requesting weather information  of the specified city from openweathermap "Current weather data" API
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={API_KEY}&units={API_UNITS}"
-    api_response = requests.get(url)
-    # Using loads method in json module to deserialize the response's json string to python dictionary
-    json_dict = json.loads(api_response.text)
+    # The city name is passed as a parameter, so requests encodes the names with '&', '#' or spaces
+    url = f"{API_BASE_URL}/data/2.5/weather"
+    api_response = http_session.get(url, params={"q": city_name, "appid": API_KEY, "units": API_UNITS}, timeout=REQUEST_TIMEOUT)
+    # Only a 404 means the city is not found. Raise HTTPError for the other errors (e.g. 401 wrong API key, 429 rate limit)
+    if api_response.status_code == 404:
+        return None
+    if not api_response.ok:
+        # Like raise_for_status(), without the url that contains the API key
+        raise requests.exceptions.HTTPError(f"{api_response.status_code} {api_response.reason}", response=api_response)
+    weather_record = parse_weather_response(api_response.content)
 
-    return json_dict
+    # Cache only the found cities
+    if weather_record is not None:
+        weather_cache.put(cache_key, weather_record)
+
+    return weather_record
 
 
-@catch_all_error_and_write_on_widget
 def get_weather_icon_by_id(icon_id):
+    # Runs in a background thread. The errors are raised to the main thread by show_weather_result
 
     # Icon_id is from weather json data, to show the current weather status by icon
-    url = f'https://openweathermap.org/img/wn/{icon_id}.png'
-    icon = requests.get(url)
+    icon_content = icon_cache.get(icon_id)
+    if icon_content is None:
+        url = f'{ICON_BASE_URL}/img/wn/{icon_id}.png'
+        icon = http_session.get(url, timeout=REQUEST_TIMEOUT)
+        # Raise HTTPError instead of caching an error page
+        icon.raise_for_status()
+        icon_content = icon.content
+        icon_cache.put(icon_id, icon_content)
     # Using BytesIO to create file like object in the memory
-    return Image.open(BytesIO(icon.content))
-
-@catch_all_error_and_write_on_widget
-def get_weather_info_from_json_dict(weather_json_dict):
-
-    # Extract the required values from the dictionary and return string 
-    if weather_json_dict['cod'] == 200: # Successful response for the queried city name
-        temp = weather_json_dict['main']['temp']
-        min_temp = weather_json_dict['main']['temp_min']
-        max_temp = weather_json_dict['main']['temp_max']
-        pressure = weather_json_dict['main']['pressure']
-        humidity = weather_json_dict['main']['humidity']
-        cloudy = weather_json_dict['clouds']['all']
-        description = weather_json_dict['weather'][0]['description']
-
-        return f"\nTemperature: {temp}°\nMin Temp: {min_temp}°\nMax Temp: {max_temp}°\nPressure: {pressure} hPa\nHumidity: {humidity}%\nCloud: {cloudy}%\nInfo: {description}"
+    return Image.open(BytesIO(icon_content))
+
+def format_weather_record(weather_record):
+    # The text shown in the window
+    return (f"\nTemperature: {weather_record.temp}°\nMin Temp: {weather_record.min_temp}°\nMax Temp: {weather_record.max_temp}°"
+            f"\nPressure: {weather_record.pressure} hPa\nHumidity: {weather_record.humidity}%\nCloud: {weather_record.cloudy}%"
+            f"\nInfo: {weather_record.description}")
+
+def fetch_bulk_row(city_name, rate_limiter):
+    # Runs in a bulk mode thread. Return one output row for the city. The errors are written in the row
+    try:
+        # Cities served by the cache don't use the api's rate
+        weather_record = get_weather_record_from_api(city_name, rate_limiter)
+        if weather_record is None:
+            return {"city": city_name, "status": "not found"}
+        return {"city": city_name, "status": "ok", **asdict(weather_record)}
+    except Exception as err:
+        return {"city": city_name, "status": "error", "error": str(err)}
+
+def fetch_weather_for_cities_in_bulk(city_names, output_file, output_format="jsonl",
+                                     max_workers=BULK_MAX_WORKERS, max_requests_per_second=BULK_MAX_REQUESTS_PER_SECOND):
+    # Fetch the weather of many cities without the GUI and write one row per city as soon as it arrives.
+    # At most max_workers cities are in flight, so a long city list is never loaded into the thread pool at once
+    rate_limiter = RateLimiter(max_requests_per_second)
+    if output_format == "csv":
+        csv_writer = csv.DictWriter(output_file, fieldnames=BULK_FIELDS, extrasaction="ignore")
+        csv_writer.writeheader()
+        write_row = csv_writer.writerow
     else:
-        # API's response: {"cod":"404","message":"city not found"}
-        return "City not found"
+        write_row = lambda row: output_file.write(json.dumps(row) + "\n")
+
+    rows_written = 0
+    city_names = iter(city_names)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        while True:
+            # Keep the pool busy with the next cities
+            for city_name in city_names:
+                city_name = city_name.strip()
+                if city_name:
+                    in_flight.add(executor.submit(fetch_bulk_row, city_name, rate_limiter))
+                if len(in_flight) >= max_workers:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                write_row(future.result())
+                rows_written += 1
+
+    return rows_written
+
+def fetch_weather(city_name):
+    # Runs in a background thread. Get the weather and then its icon, without waiting for the main loop in between
+    # Requesting the weather data for the entered city_name from openweathermap "Current weather data" api endpoint
+    weather_record = get_weather_record_from_api(city_name)
+    if weather_record is None:
+        # No icon for a city that is not found
+        return None, None
+
+    # Getting the icon that shows the weather status. The icon_id represent the status of the weather
+    icon_data = get_weather_icon_by_id(weather_record.icon_id)
+
+    return weather_record, icon_data
 
 @catch_all_error_and_write_on_widget
 def get_weather_when_click_button():
@@ -89,43 +349,63 @@ def get_weather_when_click_button():
     # To access and manipulate the global variables' values inside the function
     global city_name_value
     global weather_summary_tk_text
-    global weather_icon_tk_label
+    global current_fetch
 
     # Check the entered name is not empty
     if city_name_value.get():
-        # Requesting the weather data for the entered city_name from openweathermap "Current weather data" api endpoint
-        weather_json_dict = get_weather_json_dict_from_api(city_name_value.get())
-
-        # Check if the returned value is not None
-        if weather_json_dict is not None:
-            # Extract the required values from the dictionary and return string
-            weather_info = get_weather_info_from_json_dict(weather_json_dict)
-            # Check if the city is found
-            if weather_info == "City not found":
-                # Raise exception to handled by decorator to write it in the Text widget
-                raise Exception("City not found")
-            else:
-                # icon_id represent the status of the weather
-                icon_id = weather_json_dict['weather'][0]['icon']
-
-                # Getting the icon that shows the weather status 
-                icon_data = get_weather_icon_by_id(icon_id)
-
-                # Pillow library's' Tkinter-compatible PhotoImage widget
-                weather_status_icon = ImageTk.PhotoImage(icon_data)
-
-                # To show the weather icon in the screen
-                weather_icon_tk_label.configure(image=weather_status_icon, bg='#fff')
-                weather_icon_tk_label.image = weather_status_icon
-
-                # To show the weather information in the label widget on the screen
-                # Clear the text widget
-                weather_summary_tk_text.delete('1.0', END)
-                # Add the weather info in the text widget
-                weather_summary_tk_text.insert(END, weather_info)
+        # Cancel the previous fetch if it has not started yet. If it is running, its result is dropped
+        if current_fetch is not None:
+            current_fetch.cancel()
+        # Start the requests in the background and check for the result from the main loop
+        current_fetch = fetch_executor.submit(fetch_weather, city_name_value.get())
+        weather_summary_tk_text.delete('1.0', END)
+        weather_summary_tk_text.insert(END, "Loading...")
+        screen.after(RESULT_POLL_INTERVAL, check_weather_fetch, current_fetch)
     else:
         # Raise exception for empty name
         raise Exception("City name is empty")
+
+def check_weather_fetch(fetch):
+    # Drop the result of a fetch replaced by a newer click
+    if fetch is not current_fetch:
+        return
+    if not fetch.done():
+        # Check again later without blocking the main loop
+        screen.after(RESULT_POLL_INTERVAL, check_weather_fetch, fetch)
+        return
+    show_weather_result(fetch)
+
+@catch_all_error_and_write_on_widget
+def show_weather_result(fetch):
+
+    # To access and manipulate the global variables' values inside the function
+    global weather_summary_tk_text
+    global weather_icon_tk_label
+
+    # Clear the loading text first, so an error is not written in front of it
+    weather_summary_tk_text.delete('1.0', END)
+    # Raises the error of the background thread, so the decorator writes it in the Text widget
+    weather_record, icon_data = fetch.result()
+
+    # Check if the city is found
+    if weather_record is None:
+        # Raise exception to handled by decorator to write it in the Text widget
+        raise Exception("City not found")
+    else:
+        # The weather information as string
+        weather_info = format_weather_record(weather_record)
+
+        # Pillow library's' Tkinter-compatible PhotoImage widget
+        weather_status_icon = ImageTk.PhotoImage(icon_data)
+
+        # To show the weather icon in the screen
+        weather_icon_tk_label.configure(image=weather_status_icon, bg='#fff')
+        weather_icon_tk_label.image = weather_status_icon
+
+        # To show the weather information in the label widget on the screen
+        # Add the weather info in the text widget
+        weather_summary_tk_text.insert(END, weather_info)
+
 @catch_all_error_and_write_on_widget
 def main():
 
@@ -134,6 +414,7 @@ def main():
     global city_name_value
     global weather_summary_tk_text
     global weather_icon_tk_label
+    global screen
 
     #Initialize Window
     screen = Tk()
@@ -169,8 +450,29 @@ def main():
     weather_icon_tk_label.grid(row=3, column=0, pady=10,
                             columnspan=3, padx=20, sticky=W)
 
+    # Start with the weather and icons cached by the previous run
+    load_caches()
+
     mainloop()
 
+    # Don't start the queued fetches after the window is closed
+    fetch_executor.shutdown(wait=False, cancel_futures=True)
+    # Keep the caches for the next start
+    save_caches()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Weather app. Without options it opens the window")
+    parser.add_argument("--bulk", metavar="CITIES_FILE", help="Fetch the weather of the cities in the file (one per line) without the window")
+    parser.add_argument("--output", help="Output file of the bulk mode (default: stdout)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="Output format of the bulk mode")
+    parser.add_argument("--workers", type=int, default=BULK_MAX_WORKERS, help="Parallel requests of the bulk mode")
+    parser.add_argument("--rate", type=float, default=BULK_MAX_REQUESTS_PER_SECOND, help="Requests per second of the bulk mode")
+    args = parser.parse_args()
+
+    if args.bulk:
+        with open(args.bulk) as cities_file, (open(args.output, "w", newline="") if args.output else contextlib.nullcontext(sys.stdout)) as output_file:
+            rows_written = fetch_weather_for_cities_in_bulk(cities_file, output_file, args.format, args.workers, args.rate)
+        print(f"Fetched the weather of {rows_written} cities. Cache: {cache_statistics()}", file=sys.stderr)
+    else:
+        main()